@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+
+# A python API to drive keybanks from a long running process. Unlike cmds,
+# nothing here exits the process: errors are raised as KeybankError and the
+# results of operations are returned as namedtuples.
+#
+#   with Keybank("/kb1") as kb:
+#     result = kb.verify()
+#     if not result.ok:
+#       ...
+
+from collections import namedtuple
+from contextlib import contextmanager
+import os
+
+from .fs import KeybankFS
+from .progress import NO_PROGRESS
+from .scrub import Scrubber, SCRUB_STATE_FILE
+from .utils import KeybankError, KeybankNotAttachedError, KeybankAlreadyAttachedError, KeybankReadOnlyError
+
+
+VerifyResult = namedtuple("VerifyResult", ["ok", "differences", "untracked", "verified", "corrupted_gpg_homes"])
+BackupResult = namedtuple("BackupResult", ["backed_up", "deleted", "gpg_changes"])
+RestoreResult = namedtuple("RestoreResult", ["restored", "gpg_exports"])
+RestoreManyResult = namedtuple("RestoreManyResult", ["restored", "failed", "gpg_exports"])
+
+
+class Keybank(object):
+  # path is the keybank file and is only needed to attach. An already
+  # attached keybank can be opened with just its name.
+  # lock_timeout is how long operations wait for conflicting operations from
+  # other processes, see KeybankFS.lock. progress, if given, is a
+  # progress.Progress that backup, restore and verify report to.
+  def __init__(self, path=None, name=None, lock_timeout=None, progress=None):
+    if path is None and name is None:
+      raise ValueError("either the path or the name of the keybank is required")
+
+    self.path = path
+    self.name = name or os.path.basename(path)
+    self.lock_timeout = lock_timeout
+    self.progress = progress or NO_PROGRESS
+    self.fs = KeybankFS(self.name, path)
+    self._attached_by_us = False
+    self._scanned_key = None
+
+  def __enter__(self):
+    if not self.attached:
+      self.attach()
+
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # Only undo what we did, a keybank attached by someone else stays attached.
+    if self._attached_by_us:
+      self.detach()
+
+  @property
+  def attached(self):
+    return KeybankFS.attached(self.name)
+
+  @property
+  def mnt_path(self):
+    return self.fs.mnt_path
+
+  @property
+  def files(self):
+    # Scanned once and reused across operations, unless the manifests were
+    # changed since (e.g. by a backup from another process).
+    self._require_attached()
+    key = self._scan_key()
+    if key != self._scanned_key:
+      self.fs.scan()
+      self._scanned_key = key
+
+    return self.fs.files
+
+  def rescan(self):
+    self._scanned_key = None
+    return self.files
+
+  def _scan_key(self):
+    key = []
+    for path in ("generic/manifest.json", "generic/manifest.json.lock", "gpg"):
+      try:
+        key.append(os.stat(os.path.join(self.mnt_path, path)).st_mtime)
+      except OSError:
+        key.append(None)
+
+    return key
+
+  @contextmanager
+  def _locked(self, exclusive=False):
+    self._require_attached()
+    with self.fs.lock(exclusive=exclusive, timeout=self.lock_timeout):
+      files = self.files
+      for f in files.values():
+        f.progress = self.progress
+
+      yield files
+
+  # profile and extra_options override the recorded mount profile, see
+  # fs.MOUNT_PROFILES.
+  def attach(self, profile=None, extra_options=None):
+    if self.path is None:
+      raise KeybankError("the path of keybank '{}' is required to attach it".format(self.name))
+
+    if not os.path.isfile(self.path):
+      raise KeybankError("{} is not a valid file".format(self.path))
+
+    if self.attached:
+      raise KeybankAlreadyAttachedError("keybank '{}' already attached".format(self.name))
+
+    self.fs = KeybankFS.attach(self.path, profile=profile, extra_options=extra_options)
+    self._attached_by_us = True
+    self._scanned_key = None
+
+  def detach(self):
+    self._require_attached()
+    KeybankFS.detach(self.name)
+    self._attached_by_us = False
+    self._scanned_key = None
+
+  def verify(self, include_gpg=True):
+    with self._locked() as files:
+      generic = files["generic"].verify_report()
+      corrupted_gpg_homes = files["gpg"].verify() if include_gpg else {}
+
+    if generic is None:
+      return VerifyResult(ok=False, differences={}, untracked=[], verified=0, corrupted_gpg_homes=corrupted_gpg_homes)
+
+    ok = not generic.differences and not corrupted_gpg_homes
+    return VerifyResult(ok=ok, differences=generic.differences, untracked=generic.untracked, verified=generic.verified, corrupted_gpg_homes=corrupted_gpg_homes)
+
+  def iter_verify(self):
+    # Streams a VerifyEntry per generic file as it is verified, for keybanks
+    # with too many files to wait for (or keep) the whole result.
+    with self._locked() as files:
+      for entry in files["generic"].iter_verify():
+        yield entry
+
+  def backup(self, from_directory="/", dry_run=False, include_gpg=False, chunk_size=None, hash_algorithm=None):
+    self._require_directory(from_directory)
+    with self._locked(exclusive=not dry_run) as files:
+      generic = files["generic"]
+      generic.chunk_size = chunk_size
+      generic.hash_algorithm = hash_algorithm
+      report = generic.backup(from_directory, dry_run)
+
+      gpg_changes = {}
+      if include_gpg:
+        files["gpg"].hash_algorithm = hash_algorithm
+        gpg_changes = files["gpg"].backup(from_directory, dry_run)
+
+    return BackupResult(backed_up=report.backed_up, deleted=report.deleted, gpg_changes=gpg_changes)
+
+  def restore(self, to_directory="/", dry_run=False, include_gpg=False, only=None):
+    self._require_directory(to_directory)
+    # restoring gpg homes exports them inside the keybank
+    with self._locked(exclusive=include_gpg and not dry_run) as files:
+      restored = files["generic"].restore(to_directory, dry_run, only=only)
+      gpg_exports = files["gpg"].restore(to_directory, dry_run) if include_gpg else {}
+    return RestoreResult(restored=restored, gpg_exports=gpg_exports)
+
+  def restore_many(self, to_directories, dry_run=False, include_gpg=False, only=None):
+    # Restores to all of to_directories while reading the keybank once. Unlike
+    # restore, failures do not raise but are returned per directory, see
+    # GenericFiles.restore_many.
+    for to_directory in to_directories:
+      self._require_directory(to_directory)
+
+    with self._locked(exclusive=include_gpg and not dry_run) as files:
+      report = files["generic"].restore_many(to_directories, dry_run, only=only)
+      gpg_exports = files["gpg"].restore(to_directories[0], dry_run) if include_gpg else {}
+    return RestoreManyResult(restored=report.restored, failed=report.failed, gpg_exports=gpg_exports)
+
+  def drift(self, from_directory="/", jobs=4, full=False):
+    self._require_directory(from_directory)
+    with self._locked() as files:
+      return files["generic"].drift(from_directory, jobs=jobs, full=full)
+
+  def repair(self, from_directory="/", dry_run=False):
+    self._require_directory(from_directory)
+    with self._locked(exclusive=not dry_run) as files:
+      return files["generic"].repair(from_directory, dry_run)
+
+  def scrub(self, rate=None, max_bytes=None, max_seconds=None):
+    # Returns a scrub.ScrubReport. rate is in bytes per second. Raises
+    # KeybankScrubInProgressError if another scrub is already running.
+    self._require_attached()
+    if self.fs.read_only:
+      raise KeybankReadOnlyError("keybank '{}' is attached read-only, but scrub records its progress in the keybank".format(self.name))
+
+    with self._locked() as files:
+      scrubber = Scrubber(files["generic"], os.path.join(self.mnt_path, SCRUB_STATE_FILE), rate=rate)
+      return scrubber.run(max_bytes=max_bytes, max_seconds=max_seconds)
+
+  def _require_attached(self):
+    if not self.attached:
+      raise KeybankNotAttachedError("keybank '{}' is not attached".format(self.name))
+
+  def _require_directory(self, path):
+    if not os.path.isdir(path):
+      raise KeybankError("{} is not a valid directory".format(path))
@@ -5,28 +5,30 @@ import os
 import sys
 import logging
 
-from .fs import KeybankFS
-from .utils import fatal, quiet_call
+# Only lightweight modules are imported here. The modules doing the actual
+# work are imported by the commands that need them to keep startup fast.
+from .utils import fatal, KeybankError, quiet_call, which, DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS
 
 
 def sanity_check_git():
-  git_exists_code = quiet_call("git --version")
-  if git_exists_code:
+  git_path = which("git")
+  if git_path is None:
     fatal("git not installed. please install git before running this")
 
-  email_code = quiet_call("git config --global --get user.email")
-  name_code = quiet_call("git config --global --get user.name")
+  email_code = quiet_call([git_path, "config", "--global", "--get", "user.email"])
+  name_code = quiet_call([git_path, "config", "--global", "--get", "user.name"])
   if name_code or email_code:
     fatal("git username and email not configured.\n\nConfigure with `git config --global user.email 'you@example.com'` and `git config --global user.name 'Your Name'` before proceeding.")
 
 
-def sanity_check():
+def sanity_check(command):
   if os.geteuid() != 0:
     fatal("keybank must be run as root, preferably in xterm")
 
   os.umask(int("077", 8))
 
-  sanity_check_git()
+  if command.requires_git:
+    sanity_check_git()
 
 
 def validate_file_or_exit(path):
@@ -45,34 +47,104 @@ def validate_exists_or_exit(path):
 
 
 def validate_keybank_not_attached_or_exit(name):
+  from .fs import KeybankFS
   if KeybankFS.attached(name):
     fatal("keybank '{}' already attached. use a different name for your keybank or detach via `keybank detach`".format(name))
 
 
 def validate_keybank_attached_or_exit(name):
+  from .fs import KeybankFS
   if not KeybankFS.attached(name):
     fatal("keybank '{}' is not attached. use `keybank attach` to attach".format(name))
 
 
+def add_lock_timeout_argument(parser):
+  parser.add_argument(
+    "--lock-timeout",
+    type=float,
+    metavar="SECONDS",
+    help="how long to wait for other keybank operations on the same keybank to finish. read only operations (verify, drift, restore) can run at the same time, anything writing to the keybank runs alone. default: wait forever"
+  )
+
+
+def add_progress_argument(parser):
+  parser.add_argument(
+    "--progress",
+    choices=["auto", "tty", "log", "off"],
+    default="auto",
+    help="how to report the files and bytes done, throughput and ETA: a status line redrawn on the terminal (tty), a log line every 10 seconds (log) or not at all (off). default: auto, which picks tty if stderr is a terminal and log otherwise"
+  )
+
+
+def add_dry_run_argument(parser):
+  parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="if enabled, messages of what happens will be printed but nothing actually happens"
+  )
+
+
+def make_progress(mode):
+  from .progress import Progress, NO_PROGRESS
+  if mode == "off":
+    return NO_PROGRESS
+
+  return Progress(tty={"auto": None, "tty": True, "log": False}[mode])
+
+
 class Attach(object):
   description = "attach to a keybank file"
+  requires_git = False
 
   def __init__(self, parser):
     parser.add_argument("path", help="the path to the keybank file")
+    parser.add_argument(
+      "--read-only",
+      action="store_true",
+      help="attach with the read mount profile, for verify, restore and drift. the keybank cannot be changed until it is attached again without this"
+    )
+
+    parser.add_argument(
+      "--profile",
+      choices=["default", "read", "backup"],
+      help="the mount profile: read mounts read-only without atime updates, backup batches journal commits (noatime,commit=60). default: the profile saved with --save, or default"
+    )
+
+    parser.add_argument(
+      "--mount-options",
+      metavar="OPTIONS",
+      help="extra ext4 mount options added to the profile, e.g. commit=30"
+    )
+
+    parser.add_argument(
+      "--save",
+      action="store_true",
+      help="record --profile and --mount-options as the defaults for this keybank, in a .mount file next to it"
+    )
     self.parser = parser
 
   def validate_args(self, args):
     validate_file_or_exit(args.path)
     validate_keybank_not_attached_or_exit(os.path.basename(args.path))
+    if args.read_only and args.profile not in (None, "read"):
+      fatal("--read-only cannot be combined with --profile {}".format(args.profile))
 
   def run(self, args):
     logger = logging.getLogger()
-    kb = KeybankFS.attach(args.path)
+    from .fs import KeybankFS
+    profile = "read" if args.read_only else args.profile
+    kb = KeybankFS.attach(args.path, profile=profile, extra_options=args.mount_options)
     logger.info("keybank '{}' attached and mounted at {}".format(kb.name, kb.mnt_path))
 
+    # only recorded once the options are known to mount
+    if args.save:
+      kb.save_mount_profile(profile or "default", args.mount_options or "")
+      logger.info("saved mount profile {} for {}".format(profile or "default", args.path))
+
 
 class Detach(object):
   description = "detach from a keybank"
+  requires_git = False
 
   def __init__(self, parser):
     parser.add_argument("name", help="the name of the keybank (just the filename of your keybank file)")
@@ -82,12 +154,14 @@ class Detach(object):
 
   def run(self, args):
     logger = logging.getLogger()
+    from .fs import KeybankFS
     KeybankFS.detach(args.name)
     logger.info("keybank detached!")
 
 
 class Create(object):
   description = "create a new keybank"
+  requires_git = True
 
   def __init__(self, parser):
     parser.add_argument(
@@ -117,6 +191,7 @@ class Create(object):
       fatal("{} must be owned by root".format(parent_dir))
 
   def run(self, args):
+    from .fs import KeybankFS
     kb = KeybankFS.create(args.path, args.size)
 
     logger = logging.getLogger()
@@ -132,25 +207,20 @@ class Create(object):
     logger.info("# keybank detach {}".format(kb.name))
 
 
-class BackupRestore(object):
-  def __init__(self, parser):
-    parser.add_argument(
-      "--dry-run",
-      action="store_true",
-      help="if enabled, messages of what happens will be printed but nothing actually happens"
-    )
-
-    parser.add_argument(
-      "--include-gpg",
-      action="store_true",
-      help="if enabled, this will attempt to backup/restore gpg files"
-    )
+class MachineCommand(object):
+  # Commands between an attached keybank and a directory on the machine.
+  requires_git = False
 
+  def __init__(self, parser):
     parser.add_argument(
       "name",
       help="the name of the keybank (just the filename of your keybank file). this must already be attached."
     )
 
+    self.add_directory_argument(parser)
+    add_lock_timeout_argument(parser)
+
+  def add_directory_argument(self, parser):
     parser.add_argument(
       "directory_on_machine",
       nargs="?",
@@ -162,21 +232,78 @@ class BackupRestore(object):
     validate_dir_or_exit(args.directory_on_machine)
     validate_keybank_attached_or_exit(args.name)
 
+
+class BackupRestore(MachineCommand):
+  def __init__(self, parser):
+    add_dry_run_argument(parser)
+    parser.add_argument(
+      "--include-gpg",
+      action="store_true",
+      help="if enabled, this will attempt to backup/restore gpg files"
+    )
+
+    MachineCommand.__init__(self, parser)
+    add_progress_argument(parser)
+
   def run(self, args):
+    from .fs import KeybankFS
     kb = KeybankFS(args.name)
-    kb.scan()
-    for ttype, files in kb.files.items():
-      if ttype == "gpg" and not args.include_gpg:
-        continue
+    progress = make_progress(args.progress)
+    with kb.lock(exclusive=self.writes_keybank(args), timeout=args.lock_timeout):
+      kb.scan()
+      for files in kb.files.values():
+        files.progress = progress
+
+      self.configure(kb, args)
+      results = {}
+      for ttype, files in kb.files.items():
+        if ttype == "gpg" and not args.include_gpg:
+          continue
+
+        results[ttype] = self.run_one(ttype, files, args)
+
+    return results
+
+  def run_one(self, ttype, files, args):
+    method = getattr(files, self.method)
+    return method(args.directory_on_machine, args.dry_run, **self.method_kwargs(ttype, args))
+
+  def writes_keybank(self, args):
+    return False
 
-      method = getattr(files, self.method)
-      method(args.directory_on_machine, args.dry_run)
+  def configure(self, kb, args):
+    pass
+
+  def method_kwargs(self, ttype, args):
+    return {}
 
 
 class Backup(BackupRestore):
   description = "backs up to an attached keybank"
   method = "backup"
 
+  def __init__(self, parser):
+    BackupRestore.__init__(self, parser)
+    parser.add_argument(
+      "--chunk-size",
+      type=int,
+      help="if set, files larger than this many bytes are hashed in chunks of this size. this allows the chunks to be hashed in parallel and `keybank repair` to recopy only the corrupted chunks"
+    )
+
+    parser.add_argument(
+      "--hash-algo",
+      choices=HASH_ALGORITHMS,
+      help="the hash algorithm to back up every file with. existing backups are always verified with the algorithm they were made with. default: the algorithm already recorded for backed up files and {} for new ones".format(DEFAULT_HASH_ALGORITHM)
+    )
+
+  def writes_keybank(self, args):
+    return not args.dry_run
+
+  def configure(self, kb, args):
+    kb.files["generic"].chunk_size = args.chunk_size
+    kb.files["generic"].hash_algorithm = args.hash_algo
+    kb.files["gpg"].hash_algorithm = args.hash_algo
+
   def run(self, args):
     BackupRestore.run(self, args)
     logger = logging.getLogger()
@@ -189,18 +316,218 @@ class Restore(BackupRestore):
   description = "restores from an attached keybank"
   method = "restore"
 
+  def __init__(self, parser):
+    BackupRestore.__init__(self, parser)
+    parser.add_argument(
+      "--only",
+      action="append",
+      metavar="PATTERN",
+      help="only restore the files matching this path, glob or directory as it is on the machine (e.g. /home/johnsmith/.ssh/id_rsa). can be repeated"
+    )
+
+    parser.add_argument(
+      "--from-file",
+      metavar="LIST",
+      help="only restore the files matching the patterns in this file, one per line like --only. empty lines and lines starting with # are ignored"
+    )
+
+  def add_directory_argument(self, parser):
+    parser.add_argument(
+      "directory_on_machine",
+      nargs="*",
+      default=["/"],
+      help="the directories to restore the keys to, e.g. several container root filesystems. every file is read from the keybank once and written to all of them. default: /"
+    )
+
+  def writes_keybank(self, args):
+    # restoring gpg homes exports them inside the keybank
+    return args.include_gpg and not args.dry_run
+
+  def validate_args(self, args):
+    for directory in args.directory_on_machine:
+      validate_dir_or_exit(directory)
+
+    validate_keybank_attached_or_exit(args.name)
+    if args.from_file is not None:
+      validate_file_or_exit(args.from_file)
+
+  def run_one(self, ttype, files, args):
+    if ttype == "generic":
+      return files.restore_many(args.directory_on_machine, args.dry_run, **self.method_kwargs(ttype, args))
+
+    # gpg homes are restored inside the keybank, not to the directories
+    return files.restore(args.directory_on_machine[0], args.dry_run)
+
+  def method_kwargs(self, ttype, args):
+    if ttype != "generic" or (args.only is None and args.from_file is None):
+      return {}
+
+    patterns = list(args.only or [])
+    if args.from_file is not None:
+      with open(args.from_file) as f:
+        for line in f:
+          line = line.strip()
+          if line and not line.startswith("#"):
+            patterns.append(line)
+
+    return {"only": patterns}
+
   def run(self, args):
-    BackupRestore.run(self, args)
+    results = BackupRestore.run(self, args)
     logger = logging.getLogger()
+    failed = [d for d, paths in results["generic"].failed.items() if paths]
+    if failed:
+      fatal("restoring failed for {}, see messages above for details".format(", ".join(sorted(failed))))
+
     if not args.dry_run:
       logger.info("restore complete")
 
 
+class Repair(MachineCommand):
+  description = "recopies corrupted chunks of chunked files in an attached keybank from the machine"
+
+  def __init__(self, parser):
+    add_dry_run_argument(parser)
+    MachineCommand.__init__(self, parser)
+
+  def run(self, args):
+    logger = logging.getLogger()
+
+    from .fs import KeybankFS
+    kb = KeybankFS(args.name)
+    with kb.lock(exclusive=not args.dry_run, timeout=args.lock_timeout):
+      kb.scan()
+      unrepairable = kb.files["generic"].repair(args.directory_on_machine, args.dry_run)
+
+    if unrepairable:
+      fatal("some files could not be repaired, see messages above for details")
+
+    if not args.dry_run:
+      logger.info("repair complete, run `keybank verify` to confirm")
+
+
+class Drift(MachineCommand):
+  description = "checks if the files on the machine still match the keybank, without changing the keybank"
+
+  def __init__(self, parser):
+    parser.add_argument(
+      "--full",
+      action="store_true",
+      help="if enabled, hash every file instead of trusting files whose size and mtime did not change"
+    )
+
+    parser.add_argument(
+      "-j", "--jobs",
+      default=4,
+      type=int,
+      help="the number of files to hash in parallel. default: 4"
+    )
+
+    MachineCommand.__init__(self, parser)
+
+  def run(self, args):
+    logger = logging.getLogger()
+
+    from .fs import KeybankFS
+    kb = KeybankFS(args.name)
+    with kb.lock(timeout=args.lock_timeout):
+      kb.scan()
+      report = kb.files["generic"].drift(args.directory_on_machine, jobs=args.jobs, full=args.full)
+    logger.info("{} changed, {} missing, {} new".format(len(report.changed), len(report.missing), len(report.new)))
+    if report.changed or report.missing or report.new:
+      fatal("drift detected, see messages above for details")
+
+    logger.info("no drift detected")
+
+
+class Watch(MachineCommand):
+  description = "continuously backs up files from manifest.json as they change"
+
+  def __init__(self, parser):
+    add_dry_run_argument(parser)
+    parser.add_argument(
+      "--debounce",
+      default=2.0,
+      type=float,
+      help="seconds without new changes before a burst of changes is backed up. default: 2"
+    )
+
+    parser.add_argument(
+      "--max-delay",
+      default=30.0,
+      type=float,
+      help="maximum seconds a change waits before being backed up, even if changes keep coming. default: 30"
+    )
+
+    MachineCommand.__init__(self, parser)
+
+  def run(self, args):
+    logger = logging.getLogger()
+    from .fs import KeybankFS
+    kb = KeybankFS(args.name)
+    with kb.lock(timeout=args.lock_timeout):
+      kb.scan()
+
+    # The lock is only held while a batch of changes is backed up
+    def lock():
+      return kb.lock(exclusive=not args.dry_run, timeout=args.lock_timeout)
+
+    from .watch import ManifestWatcher
+    watcher = ManifestWatcher(kb.files["generic"], args.directory_on_machine, debounce=args.debounce, max_delay=args.max_delay, dry_run=args.dry_run, lock=lock)
+    try:
+      watcher.run()
+    except KeyboardInterrupt:
+      logger.info("stopped watching")
+      logger.info("remember to do `git commit` after you examine the changes")
+
+
+class Replicate(object):
+  description = "copies only the changed blocks of a detached keybank file to another file, e.g. an offsite copy"
+  requires_git = False
+
+  def __init__(self, parser):
+    parser.add_argument(
+      "--dry-run",
+      action="store_true",
+      help="if enabled, messages of what happens will be printed but nothing actually happens"
+    )
+
+    parser.add_argument(
+      "--block-size",
+      default=1024*1024,
+      type=int,
+      help="the size of the blocks compared between the files in bytes. default: 1MB"
+    )
+
+    parser.add_argument("src_file", help="the path to the keybank file to copy from. it must not be attached")
+    parser.add_argument("dest_file", help="the path to the copy. the block map of the copy is stored next to it as DEST_FILE.blockmap")
+
+  def validate_args(self, args):
+    validate_file_or_exit(args.src_file)
+    # An attached keybank may be written to while it is being copied.
+    from .fs import KeybankFS
+    if KeybankFS.attached(os.path.basename(args.src_file)):
+      fatal("keybank '{}' is attached. detach it via `keybank detach` before replicating".format(os.path.basename(args.src_file)))
+
+    if os.path.exists(args.dest_file) and not os.path.isfile(args.dest_file):
+      fatal("{0} is not a valid file".format(args.dest_file))
+
+    if args.block_size <= 0:
+      fatal("--block-size must be positive")
+
+  def run(self, args):
+    from .replicate import BlockReplicator
+    BlockReplicator(args.src_file, args.dest_file, block_size=args.block_size).replicate(args.dry_run)
+
+
 class Verify(object):
   description = "verifies a keybank"
+  requires_git = False
 
   def __init__(self, parser):
     parser.add_argument("name", help="the name of the keybank (just the filename of your keybank file)")
+    add_lock_timeout_argument(parser)
+    add_progress_argument(parser)
 
   def validate_args(self, args):
     validate_keybank_attached_or_exit(args.name)
@@ -208,13 +535,63 @@ class Verify(object):
   def run(self, args):
     logger = logging.getLogger()
 
-    kb = KeybankFS(args.name)
-    kb.scan()
-    for ttype, files in kb.files.items():
-      if files.verify():
-        fatal("verification failed, see messages above for details")
+    from .api import Keybank
+    result = Keybank(name=args.name, lock_timeout=args.lock_timeout, progress=make_progress(args.progress)).verify()
+    if not result.ok:
+      fatal("verification failed, see messages above for details")
+
+    logger.info("verification successful, {} files verified".format(result.verified))
+
+
+class Scrub(object):
+  description = "verifies a keybank a little at a time, resuming where the last scrub stopped"
+  requires_git = False
+
+  def __init__(self, parser):
+    parser.add_argument("name", help="the name of the keybank (just the filename of your keybank file)")
+
+    parser.add_argument(
+      "--rate",
+      type=int,
+      metavar="BYTES",
+      help="maximum bytes per second read from the keybank. default: unlimited"
+    )
+
+    parser.add_argument(
+      "--max-bytes",
+      type=int,
+      help="stop after reading this many bytes, the next scrub continues from there"
+    )
+
+    parser.add_argument(
+      "--max-time",
+      type=float,
+      metavar="SECONDS",
+      help="stop after this many seconds, the next scrub continues from there"
+    )
+
+    add_lock_timeout_argument(parser)
 
-    logger.info("verification successful")
+  def validate_args(self, args):
+    validate_keybank_attached_or_exit(args.name)
+    for value, option in ((args.rate, "--rate"), (args.max_bytes, "--max-bytes"), (args.max_time, "--max-time")):
+      if value is not None and value <= 0:
+        fatal("{} must be positive".format(option))
+
+  def run(self, args):
+    logger = logging.getLogger()
+
+    from .api import Keybank
+    from .utils import KeybankScrubInProgressError
+    try:
+      report = Keybank(name=args.name, lock_timeout=args.lock_timeout).scrub(rate=args.rate, max_bytes=args.max_bytes, max_seconds=args.max_time)
+    except KeybankScrubInProgressError as e:
+      logger.info("{}, nothing to do".format(e))
+      return
+    if report.differences:
+      fatal("scrub found {} corrupted or missing files, see messages above for details".format(len(report.differences)))
+
+    logger.info("scrub successful, {} files verified".format(report.verified))
 
 
 commands = [
@@ -223,7 +600,12 @@ commands = [
   Create,
   Backup,
   Restore,
-  Verify
+  Verify,
+  Scrub,
+  Repair,
+  Drift,
+  Replicate,
+  Watch
 ]
 
 
@@ -234,8 +616,6 @@ OTR, GPG keys.
 
 
 def main():
-  sanity_check()
-
   parser = argparse.ArgumentParser(description=DESCRIPTION)
   subparsers = parser.add_subparsers()
   for command_cls in commands:
@@ -253,7 +633,12 @@ def main():
     print("{}: error: too few arguments".format(parser.prog), file=sys.stderr)
     sys.exit(1)
 
+  sanity_check(args.cmd)
+
   logging.basicConfig(format="[%(asctime)s][%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.DEBUG)
 
-  args.cmd.validate_args(args)
-  args.cmd.run(args)
+  try:
+    args.cmd.validate_args(args)
+    args.cmd.run(args)
+  except KeybankError as e:
+    fatal(str(e))
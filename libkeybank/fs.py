@@ -1,14 +1,55 @@
 from __future__ import absolute_import, print_function
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
 import logging
 import os
 import os.path
+import time
 
-from .utils import execute, chdir, mkdir_p
+from .utils import execute, chdir, mkdir_p, KeybankError, KeybankLockTimeoutError, KeybankReadOnlyError
 from .generic_files import GenericFiles
 from .gpg_files import GPGFiles
 
 
+# Mount options of the ext4 filesystem inside a keybank. "read" is for
+# attaches that only verify, restore or check for drift: the LUKS mapping and
+# the filesystem are read-only and reads do not update atimes. "backup" is for
+# the many small writes of backups, whose journal commits are batched.
+MOUNT_PROFILES = {
+  "default": "",
+  "read": "ro,noatime",
+  "backup": "noatime,commit=60",
+}
+
+# The mount profile of a keybank is recorded next to the keybank file, as it
+# is needed before the keybank can be opened.
+MOUNT_PROFILE_SUFFIX = ".mount"
+
+
+def mount_options(profile, extra_options=""):
+  if profile not in MOUNT_PROFILES:
+    raise KeybankError("unknown mount profile {}, must be one of {}".format(profile, ", ".join(sorted(MOUNT_PROFILES))))
+
+  # Options are merged by key, so commit=30 replaces the commit=60 of the
+  # backup profile. ro and rw share a key, but the read profile is only
+  # mounted read-only and can not be turned into a read-write mount.
+  profile_options = [o for o in MOUNT_PROFILES[profile].split(",") if o]
+  extra = [o for o in extra_options.split(",") if o]
+  if "ro" in profile_options and "rw" in extra:
+    raise KeybankError("mount option rw can not be used with the {} profile".format(profile))
+
+  options = OrderedDict()
+  for option in profile_options + extra:
+    key = option.split("=", 1)[0]
+    options["ro" if key == "rw" else key] = option
+
+  return ",".join(options.values())
+
+
 def create_sparse_file(path, size):
   with open(path, "w") as f:
     f.seek(size-1)
@@ -26,10 +67,12 @@ class KeybankFS(object):
     kfs._create(size)
     return kfs
 
+  # profile and extra_options override the mount profile recorded for the
+  # keybank for this attach, see MOUNT_PROFILES.
   @classmethod
-  def attach(cls, path):
+  def attach(cls, path, profile=None, extra_options=None):
     kfs = cls(os.path.basename(path), path)
-    kfs._attach()
+    kfs._attach(profile, extra_options)
     return kfs
 
   @classmethod
@@ -47,9 +90,79 @@ class KeybankFS(object):
 
     self.files = {}
 
+  @property
+  def mount_profile_path(self):
+    return self.path + MOUNT_PROFILE_SUFFIX
+
+  def load_mount_profile(self):
+    # Returns the recorded (profile, extra options).
+    try:
+      with open(self.mount_profile_path) as f:
+        recorded = json.load(f)
+    except IOError:
+      return "default", ""
+
+    return recorded.get("profile", "default"), recorded.get("options", "")
+
+  def save_mount_profile(self, profile, extra_options=""):
+    mount_options(profile, extra_options)  # validates the profile
+    with open(self.mount_profile_path, "w") as f:
+      json.dump({"profile": profile, "options": extra_options}, f, indent=2, sort_keys=True)
+
+  @property
+  def read_only(self):
+    # Whether the keybank is mounted read-only, according to /proc/mounts.
+    with open("/proc/mounts") as f:
+      for line in f:
+        fields = line.split()
+        if len(fields) >= 4 and fields[1] == self.mnt_path:
+          return "ro" in fields[3].split(",")
+
+    return False
+
+  @contextmanager
+  def lock(self, exclusive=False, timeout=None):
+    # Serializes operations on an attached keybank with flock on its mount
+    # point. Read only operations take a shared lock and can run in parallel,
+    # anything writing to the keybank takes an exclusive lock. timeout is in
+    # seconds, None waits forever. Yields the time spent waiting.
+    if exclusive and self.read_only:
+      raise KeybankReadOnlyError("keybank '{}' is attached read-only, detach it and attach it without --read-only to change it".format(self.name))
+
+    kind = "exclusive" if exclusive else "shared"
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    fd = os.open(self.mnt_path, os.O_RDONLY)
+    try:
+      start = time.time()
+      if not self._try_lock(fd, operation):
+        self.logger.info("waiting for {} lock on keybank '{}', another keybank operation is running".format(kind, self.name))
+        if timeout is None:
+          fcntl.flock(fd, operation)
+        else:
+          while not self._try_lock(fd, operation):
+            if time.time() - start >= timeout:
+              raise KeybankLockTimeoutError("timed out after {}s waiting for {} lock on keybank '{}'".format(timeout, kind, self.name))
+            time.sleep(0.05)
+
+      waited = time.time() - start
+      self.logger.info("acquired {} lock on keybank '{}' after waiting {:.2f}s".format(kind, self.name, waited))
+      yield waited
+    finally:
+      # closing the file descriptor releases the lock
+      os.close(fd)
+
+  def _try_lock(self, fd, operation):
+    try:
+      fcntl.flock(fd, operation | fcntl.LOCK_NB)
+      return True
+    except (IOError, OSError) as e:
+      if e.errno in (errno.EAGAIN, errno.EACCES):
+        return False
+      raise
+
   def sanity_check(self):
     if not os.path.isfile(self.manifest_path):
-      raise RuntimeError("cannot find manifest.json in the generic folder")
+      raise KeybankError("cannot find manifest.json in the generic folder")
 
   def scan(self):
     self.logger.info("scanning keybank")
@@ -80,10 +193,30 @@ class KeybankFS(object):
     self._setup_luks_and_fs()
     self._initialize_directory_structure()
 
-  def _attach(self):
-    execute("cryptsetup luksOpen {} {}".format(self.path, self.name))
+  def _attach(self, profile=None, extra_options=None):
+    recorded_profile, recorded_options = self.load_mount_profile()
+    if profile is None:
+      profile = recorded_profile
+    if extra_options is None:
+      extra_options = recorded_options
+
+    options = mount_options(profile, extra_options)
+    read_only = "ro" in options.split(",")
+    self.logger.info("attaching keybank '{}' with mount profile {} ({})".format(self.name, profile, options or "defaults"))
+
+    # A read-only mapping makes sure nothing, not even a journal replay, can
+    # write to the keybank file.
+    execute("cryptsetup luksOpen {}{} {}".format("--readonly " if read_only else "", self.path, self.name))
     mkdir_p(self.mnt_path)
-    execute("mount {} {}".format(self.mapper_path, self.mnt_path))
+    try:
+      execute("mount {}{} {}".format("-o {} ".format(options) if options else "", self.mapper_path, self.mnt_path))
+    except KeybankError:
+      if read_only:
+        self.logger.error("the filesystem may need its journal replayed, which a read-only attach cannot do. attach it read-write once to recover")
+
+      os.rmdir(self.mnt_path)
+      execute("cryptsetup luksClose {}".format(self.name))
+      raise
 
   def _detach(self):
     execute("umount {}".format(self.mnt_path))
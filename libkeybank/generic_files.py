@@ -1,18 +1,157 @@
 from __future__ import absolute_import
 
+from bisect import bisect_left
 from collections import namedtuple
-import glob
+from multiprocessing.pool import ThreadPool
 import logging
 import json
 import os.path
 import shutil
+import tempfile
 from pwd import getpwuid, getpwnam
 from grp import getgrgid, getgrnam
 
-from .utils import hash_file, mkdir_p, execute
+from .progress import NO_PROGRESS
+from .walk import ExcludeRules, glob_paths, walk_files, GLOB_MAGIC
+from .utils import copy_file, hash_file, hash_file_chunks, merkle_root, mkdir_p, execute, path_matches_glob, lock_hash_algorithm, KeybankError, LEGACY_HASH_ALGORITHM
+
+
+FailedHashExpectation = namedtuple("FailedHashExpectation", ["expected", "actual", "ranges"])
+DriftReport = namedtuple("DriftReport", ["changed", "missing", "new"])
+VerifyReport = namedtuple("VerifyReport", ["differences", "untracked", "verified"])
+VerifyEntry = namedtuple("VerifyEntry", ["path", "status", "expected", "actual", "ranges"])
+
+VERIFIED = "verified"
+DIFFERENT = "different"
+MISSING = "missing"
+UNTRACKED = "untracked"
+BackupReport = namedtuple("BackupReport", ["backed_up", "deleted"])
+# restored maps every restore directory to the paths restored to it, failed
+# to a dict of the paths that failed and why.
+RestoreReport = namedtuple("RestoreReport", ["restored", "failed"])
+
+
+# Files in the keybank that are not backups of files from the machine.
+KEYBANK_EXCLUDES = ExcludeRules([".git", "/manifest.json", "/manifest.json.lock"])
+
+
+class LockIndex(object):
+  # Resolves restore selections against the paths of a locked manifest
+  # without scanning all of them. Exact paths are dict lookups. Globs and
+  # directories only look at the range of the sorted paths that share their
+  # literal prefix, found by bisection.
+  def __init__(self, locked_manifest):
+    self.locked_manifest = locked_manifest
+    self._sorted_paths = None
+
+  @property
+  def sorted_paths(self):
+    if self._sorted_paths is None:
+      self._sorted_paths = sorted(self.locked_manifest)
+
+    return self._sorted_paths
+
+  def with_prefix(self, prefix):
+    paths = self.sorted_paths
+    i = bisect_left(paths, prefix)
+    while i < len(paths) and paths[i].startswith(prefix):
+      yield paths[i]
+      i += 1
+
+  def match(self, pattern):
+    pattern = "/" + pattern.strip().lstrip("/")
+    magic = GLOB_MAGIC.search(pattern)
+    if magic is not None:
+      return [path for path in self.with_prefix(pattern[:magic.start()]) if path_matches_glob(path, pattern)]
+
+    if pattern in self.locked_manifest:
+      return [pattern]
+
+    return list(self.with_prefix(pattern.rstrip("/") + "/"))
+
+  def select(self, patterns):
+    selected = set()
+    for pattern in patterns:
+      matches = self.match(pattern)
+      if not matches:
+        raise KeybankError("{} does not match anything in manifest.json.lock".format(pattern))
+
+      selected.update(matches)
+
+    return sorted(selected)
+
+
+class OwnerMap(object):
+  # Maps the owner and group names of the locked manifest to ids for one
+  # restore directory. A directory with its own etc/passwd and etc/group (the
+  # root filesystem of a container or chroot) is mapped with those, anything
+  # else with the name service of the machine. The name service lookups are
+  # cached in nss_cache, which can be shared between maps.
+  def __init__(self, root, nss_cache=None):
+    self.root = root
+    self.nss_cache = nss_cache if nss_cache is not None else {}
+    self.users = self._read_ids("passwd")
+    self.groups = self._read_ids("group")
+
+  def _read_ids(self, name):
+    if os.path.realpath(self.root) == "/":
+      return None
+
+    path = os.path.join(self.root, "etc", name)
+    if not os.path.isfile(path):
+      return None
+
+    ids = {}
+    with open(path) as f:
+      for line in f:
+        fields = line.rstrip("\n").split(":")
+        if len(fields) < 3 or line.startswith("#"):
+          continue
+
+        try:
+          ids.setdefault(fields[0], int(fields[2]))
+        except ValueError:
+          pass
+
+    return ids
+
+  def uid(self, owner):
+    return self._lookup("user", owner, self.users, "passwd", lambda: getpwnam(owner).pw_uid)
+
+  def gid(self, group):
+    return self._lookup("group", group, self.groups, "group", lambda: getgrnam(group).gr_gid)
+
+  def _lookup(self, kind, name, ids, filename, nss_lookup):
+    if ids is not None:
+      if name not in ids:
+        raise KeybankError("no {} {} in {}".format(kind, name, os.path.join(self.root, "etc", filename)))
+
+      return ids[name]
+
+    key = (kind, name)
+    if key not in self.nss_cache:
+      try:
+        self.nss_cache[key] = nss_lookup()
+      except KeyError:
+        raise KeybankError("no {} {} on this machine".format(kind, name))
 
+    return self.nss_cache[key]
 
-FailedHashExpectation = namedtuple("FailedHashExpectation", ["expected", "actual"])
+
+def _owner_names(stat):
+  # The owner and group names of a file, or their ids if they have no name
+  # (e.g. the user was deleted).
+  try:
+    owner = getpwuid(stat.st_uid).pw_name
+  except KeyError:
+    owner = str(stat.st_uid)
+
+  try:
+    group = getgrgid(stat.st_gid).gr_name
+  except KeyError:
+    group = str(stat.st_gid)
+
+  return owner, group
 
 
 class GenericFiles(object):
@@ -35,7 +174,20 @@ class GenericFiles(object):
     self.manifest_lock_path = os.path.join(self.path, "manifest.json.lock")
 
     self.manifest = []
+    self.excludes = ExcludeRules()
     self.locked_manifest = {}
+    self._lock_index = None
+
+    # Files larger than chunk_size are backed up with a per chunk hash tree
+    # instead of a single hash. None disables chunking for new backups.
+    self.chunk_size = None
+    self.jobs = 4
+    # see progress.Progress
+    self.progress = NO_PROGRESS
+    # The algorithm to back up every file with, None keeps the recorded one,
+    # see utils.lock_hash_algorithm. Existing entries are always verified
+    # with the algorithm recorded in them.
+    self.hash_algorithm = None
 
     self.scan()
 
@@ -44,134 +196,592 @@ class GenericFiles(object):
       self.manifest = json.load(f)
 
     if not isinstance(self.manifest, list):
-      raise TypeError("manifest.json must contain a list, not a {}".format(type(self.manifest)))
+      raise KeybankError("manifest.json must contain a list, not a {}".format(type(self.manifest)))
+
+    # Entries like {"exclude": "*.lock"} are not files to back up but are
+    # applied to all the globs of the other entries, see walk.ExcludeRules.
+    self.excludes = ExcludeRules.from_manifest(self.manifest)
+    self.manifest = [entry for entry in self.manifest if "exclude" not in entry]
 
     if os.path.exists(self.manifest_lock_path):
       with open(self.manifest_lock_path) as f:
         self.locked_manifest = json.load(f)
 
     if not isinstance(self.locked_manifest, dict):
-      raise TypeError("manifest.json.lock must contain a dict, not a {}".format(type(self.manifest)))
+      raise KeybankError("manifest.json.lock must contain a dict, not a {}".format(type(self.locked_manifest)))
 
-  def hash_all_files(self, base, excludes={".git", "/manifest.json", "/manifest.json.lock"}):
+  def hash_all_files(self, base, excludes=KEYBANK_EXCLUDES):
     hashes = {}
-    for root, dirs, files in os.walk(base):
-      # Inefficient but sufficient for now
-      for d in dirs[:]:
-        if d in excludes:
-          dirs.remove(d)
-
-      for fn in files:
-        path = os.path.join(root, fn)
-        relative_absolute_path = self.get_relative_absolute_path(path, base)
-
-        if relative_absolute_path in excludes:
-          continue
-        else:
-          hashes[relative_absolute_path] = hash_file(path)
+    for relative_absolute_path, path in self.list_all_files(base, excludes):
+      hashes[relative_absolute_path] = hash_file(path)
 
     return hashes
 
+  def list_all_files(self, base, excludes=KEYBANK_EXCLUDES):
+    # Sorted by relative absolute path, see iter_verify.
+    return walk_files(base, excludes)
+
   def verify(self):
+    # Returns a truthy value if there are differences (or nothing to verify).
+    report = self.verify_report()
+    if report is None:
+      return True
+
+    return report.differences
+
+  def verify_report(self):
+    # Like verify, but returns a VerifyReport (or None if there is no locked
+    # manifest to verify against) instead of only the differences. Only the
+    # problems are kept around, verified files are just counted.
     self.logger.info("verifying generic files")
     if not self.locked_manifest:
       self.logger.warning("empty or no manifest.json.lock file found, skipping generic files verification")
       self.logger.warning("this could be because the backup was not initialize or nothing is in the backup")
-      return True
-
-    all_file_hashes = self.hash_all_files(self.path)
-    expected_hashes = {fn: data["hash"] for fn, data in self.locked_manifest.items()}
+      return None
 
     different_hashes = {}
-    for fn, actual_hash in all_file_hashes.items():
-      expected_hash = expected_hashes.pop(fn, None)
-      if actual_hash != expected_hash:
-        if expected_hash is None:
-          self.logger.warning("detected file not by tracked manifest: {}".format(fn))
-        else:  # impossible right now for actual_hash to be None
-          different_hashes[fn] = FailedHashExpectation(expected=expected_hash, actual=actual_hash)
-          self.logger.error("difference detected for {}: {} (expected) != {} (actual)".format(fn, expected_hash, actual_hash))
+    untracked = []
+    verified = 0
+    for result in self.iter_verify():
+      if result.status == VERIFIED:
+        verified += 1
+      elif result.status == UNTRACKED:
+        untracked.append(result.path)
       else:
-        self.logger.info("verified {}".format(fn))
-
-    # Anything left over are files that we are supposed to have checked but
-    # is no longer on the disk
-    for fn, expected_hash in expected_hashes:
-      different_hashes[fn] = FailedHashExpectation(expected=expected_hash, actual=None)
+        different_hashes[result.path] = FailedHashExpectation(expected=result.expected, actual=result.actual, ranges=result.ranges)
+
+    return VerifyReport(differences=different_hashes, untracked=untracked, verified=verified)
+
+  def iter_verify(self):
+    # Streams a VerifyEntry for every file in the keybank or the locked
+    # manifest, logging each one as it goes. Both the keybank walk and the
+    # locked manifest entries are sorted by path, so they can be merge joined
+    # and every file is hashed as it comes by, without building a dict of all
+    # the hashes first.
+    expected_paths = iter(sorted(self.locked_manifest))
+    actual_files = self.list_all_files(self.path)
+    progress = self.progress
+    if progress.enabled:
+      progress.start("verifying generic files", len(self.locked_manifest), self._keybank_size(self.locked_manifest))
+
+    fn = next(expected_paths, None)
+    actual = next(actual_files, None)
+    while fn is not None or actual is not None:
+      if actual is None or (fn is not None and fn < actual[0]):
+        entry = self.locked_manifest[fn]
+        self.logger.error("file tracked by manifest but no longer on disk: {}".format(fn))
+        progress.file_done()
+        yield VerifyEntry(path=fn, status=MISSING, expected=entry["hash"], actual=None, ranges=None)
+        fn = next(expected_paths, None)
+      elif fn is None or actual[0] < fn:
+        self.logger.warning("detected file not by tracked manifest: {}".format(actual[0]))
+        yield VerifyEntry(path=actual[0], status=UNTRACKED, expected=None, actual=None, ranges=None)
+        actual = next(actual_files, None)
+      else:
+        result = self._verify_one(fn, actual[1], self.locked_manifest[fn], progress.add_bytes if progress.enabled else None)
+        progress.file_done()
+        yield result
+        fn = next(expected_paths, None)
+        actual = next(actual_files, None)
+
+    progress.finish()
+
+  def _keybank_size(self, paths):
+    # The total size of the backups of paths, for progress reporting.
+    total = 0
+    for fn in paths:
+      try:
+        total += os.path.getsize(self.keybank_path(fn))
+      except OSError:
+        pass
+
+    return total
+
+  def verify_path(self, fn, on_read=None):
+    # Verifies a single file of the locked manifest, see scrub.
+    entry = self.locked_manifest[fn]
+    path = self.keybank_path(fn)
+    if not os.path.isfile(path):
       self.logger.error("file tracked by manifest but no longer on disk: {}".format(fn))
+      return VerifyEntry(path=fn, status=MISSING, expected=entry["hash"], actual=None, ranges=None)
+
+    return self._verify_one(fn, path, entry, on_read)
+
+  def _verify_one(self, fn, path, entry, on_read=None):
+    actual_hash, actual_chunks = self._hash_like_entry(path, entry, on_read)
+    if actual_hash == entry["hash"]:
+      self.logger.info("verified {}".format(fn))
+      return VerifyEntry(path=fn, status=VERIFIED, expected=entry["hash"], actual=actual_hash, ranges=None)
+
+    ranges = None
+    if actual_chunks is not None:
+      ranges = self._differing_ranges(entry, actual_chunks, os.path.getsize(path))
+
+    self.logger.error("difference detected for {}: {} (expected) != {} (actual)".format(fn, entry["hash"], actual_hash))
+    for start, end in ranges or []:
+      self.logger.error("  bytes {}-{} differ".format(start, end))
+
+    return VerifyEntry(path=fn, status=DIFFERENT, expected=entry["hash"], actual=actual_hash, ranges=ranges)
+
+  def repair(self, from_directory, dry_run):
+    # Recopies only the chunks of chunked files that no longer match the lock,
+    # as long as the file on the machine still has the backed up content for
+    # those chunks.
+    self.logger.info("repairing generic files")
+    unrepairable = []
+    for fn, entry in sorted(self.locked_manifest.items()):
+      if "chunks" not in entry:
+        continue
+
+      path = self.keybank_path(fn)
+      from_path = os.path.join(from_directory, fn.lstrip("/"))
+      if not os.path.isfile(path):
+        self.logger.error("{} is missing from the keybank, run a backup instead".format(fn))
+        unrepairable.append(fn)
+        continue
+
+      actual_size = os.path.getsize(path)
+      _, actual_chunks = self._hash_like_entry(path, entry)
+      ranges = self._differing_ranges(entry, actual_chunks, actual_size)
+      if not ranges:
+        continue
+
+      if not os.path.isfile(from_path):
+        self.logger.error("{} is corrupted and missing on the machine, cannot repair".format(fn))
+        unrepairable.append(fn)
+        continue
+
+      _, source_chunks = self._hash_like_entry(from_path, entry)
+      repaired = True
+      with open(from_path, "rb") as src:
+        with open(path, "r+b") as dst:
+          for start, end in ranges:
+            for offset in range(start, end, entry["chunk_size"]):
+              i = offset // entry["chunk_size"]
+              if i >= len(entry["chunks"]):
+                # Past the end of the backed up file, truncated below.
+                continue
+
+              if i >= len(source_chunks) or source_chunks[i] != entry["chunks"][i]:
+                self.logger.error("{} bytes {}-{} changed on the machine since the backup, cannot repair".format(fn, offset, offset + entry["chunk_size"]))
+                repaired = False
+                continue
+
+              self.logger.info("recopy {} bytes {}-{} from {}".format(fn, offset, offset + entry["chunk_size"], from_path))
+              if not dry_run:
+                src.seek(offset)
+                dst.seek(offset)
+                dst.write(src.read(entry["chunk_size"]))
+
+          if not dry_run and actual_size != entry["size"]:
+            dst.truncate(entry["size"])
+
+      if not repaired:
+        unrepairable.append(fn)
+
+    return unrepairable
+
+  def drift(self, from_directory, jobs=4, full=False):
+    self.logger.info("checking generic files on the machine for drift")
+    changed = {}
+    missing = []
+    to_hash = []
+
+    for fn, data in sorted(self.locked_manifest.items()):
+      from_path = os.path.join(from_directory, fn.lstrip("/"))
+      try:
+        live_stat = os.stat(from_path)
+      except OSError:
+        missing.append(fn)
+        self.logger.error("file tracked by manifest but missing on the machine: {}".format(from_path))
+        continue
+
+      owner, group = _owner_names(live_stat)
+      if (owner, group) != (data["owner"], data["group"]):
+        changed[fn] = "owner:group changed from {}:{} to {}:{}".format(data["owner"], data["group"], owner, group)
+        continue
+
+      # The keybank copy keeps the size and mtime of the machine file at the
+      # time of the backup (copy2), so it can be used to skip most hashing.
+      try:
+        backup_stat = os.stat(self.keybank_path(fn))
+      except OSError:
+        backup_stat = None
+
+      if backup_stat is not None and backup_stat.st_size != live_stat.st_size:
+        changed[fn] = "size changed from {} to {}".format(backup_stat.st_size, live_stat.st_size)
+      elif not full and backup_stat is not None and backup_stat.st_mtime == live_stat.st_mtime:
+        self.logger.debug("{} has the same size and mtime, not hashing".format(from_path))
+      else:
+        to_hash.append((fn, from_path, data))
+
+    if to_hash:
+      pool = ThreadPool(max(1, jobs))
+      try:
+        actual_hashes = pool.map(lambda item: self._hash_like_entry(item[1], item[2])[0], to_hash)
+      finally:
+        pool.close()
+        pool.join()
+
+      for (fn, _, data), actual_hash in zip(to_hash, actual_hashes):
+        if actual_hash != data["hash"]:
+          changed[fn] = "content changed: {} (backed up) != {} (machine)".format(data["hash"], actual_hash)
+
+    for fn, reason in sorted(changed.items()):
+      self.logger.error("drift detected for {}: {}".format(fn, reason))
+
+    new = []
+    for entry in self.manifest:
+      for from_path in self.expand_path(entry["path"], base=from_directory):
+        fn = self.get_relative_absolute_path(from_path, from_directory)
+        if fn not in self.locked_manifest:
+          new.append(fn)
+          self.logger.warning("file matched by manifest but not backed up: {}".format(from_path))
 
-    return different_hashes
+    return DriftReport(changed=changed, missing=missing, new=sorted(new))
 
   def backup(self, from_directory, dry_run):
     self.logger.info("backing up generic files")
     locked_manifest = {}
 
+    # All the globs are expanded first so that the progress has totals.
+    from_paths = []
     for entry in self.manifest:
       paths = self.expand_path(entry["path"], base=from_directory)
       if len(paths) != entry["amount"]:
-        raise RuntimeError("expected {} files for {} but got {}: {}".format(entry["amount"], entry["path"], len(paths), paths))
-
-      for from_path in paths:
-        relative_absolute_path = self.get_relative_absolute_path(from_path, from_directory)
-        stat = os.stat(from_path)
-        locked_manifest[relative_absolute_path] = {
-          "hash": hash_file(from_path),
-          "owner": getpwuid(stat.st_uid).pw_name,
-          "group": getgrgid(stat.st_gid).gr_name,
-        }
-        to_path = relative_absolute_path.lstrip("/")
-        to_path = os.path.join(self.path, to_path)
-        self.logger.info("copy {} to {} with hash {}".format(from_path, to_path, locked_manifest[relative_absolute_path]["hash"]))
+        raise KeybankError("expected {} files for {} but got {}: {}".format(entry["amount"], entry["path"], len(paths), paths))
 
-        if not dry_run:
-          dirname = os.path.dirname(to_path)
-          mkdir_p(dirname)
-          shutil.copy2(from_path, to_path)
-          os.chown(to_path, 0, 0)
-          os.chmod(to_path, int("0600", 8))
+      from_paths.extend(paths)
+
+    # Every file is read twice, once to hash it and once to copy it.
+    progress = self.progress
+    on_read = progress.add_bytes if progress.enabled else None
+    if progress.enabled:
+      passes = 1 if dry_run else 2
+      progress.start("backing up generic files", len(from_paths), passes * sum(os.path.getsize(path) for path in from_paths))
 
-    locked_manifest_str = json.dumps(locked_manifest, sort_keys=True, indent=4, separators=(",", ": "))
+    for from_path in from_paths:
+      relative_absolute_path = self.get_relative_absolute_path(from_path, from_directory)
+      previous = self.locked_manifest.get(relative_absolute_path)
+      locked_manifest[relative_absolute_path] = self._lock_entry(from_path, on_read, previous)
+      self._copy_to_keybank(from_path, relative_absolute_path, locked_manifest[relative_absolute_path], dry_run, on_read)
+      progress.file_done()
+
+    progress.finish()
+
+    locked_manifest_str = self._dump_locked_manifest(locked_manifest)
     self.logger.info("dump locked manifest as follows:")
     for line in locked_manifest_str.split("\n"):
       self.logger.info(line)
 
     if not dry_run:
-      with open(self.manifest_lock_path, "w") as f:
-        f.write(locked_manifest_str)
+      self._write_locked_manifest(locked_manifest)
+      self.locked_manifest = locked_manifest
 
-    actual_file_hashes = self.hash_all_files(self.path)
-    for fn in actual_file_hashes:
+    deleted = []
+    for fn, _ in list(self.list_all_files(self.path)):
       if fn not in locked_manifest:
+        deleted.append(fn)
         self.logger.info("{} is on file system but not tracked by manifest, deleting...".format(fn))
         if not dry_run:
-          os.remove(os.path.join(self.path, fn.lstrip("/")))
+          os.remove(self.keybank_path(fn))
+
+    return BackupReport(backed_up=sorted(locked_manifest), deleted=sorted(deleted))
+
+  # Incremental version of backup: only the given machine paths are looked at
+  # and the locked manifest is updated in place. Paths not covered by the
+  # manifest are ignored and tracked paths that no longer exist are dropped.
+  # Returns the relative absolute paths whose lock entry changed.
+  def backup_paths(self, paths, from_directory, dry_run):
+    changed = []
+    locked_manifest = dict(self.locked_manifest)
+
+    for from_path in sorted(set(paths)):
+      relative_absolute_path = self.get_relative_absolute_path(from_path, from_directory)
+      if self.manifest_entry_for(relative_absolute_path) is None:
+        continue
+
+      if os.path.isfile(from_path):
+        previous = locked_manifest.get(relative_absolute_path)
+        if previous is None:
+          entry = self._lock_entry(from_path)
+        else:
+          entry = self._relock_entry(from_path, previous)
+
+        if previous == entry:
+          self.logger.debug("{} unchanged, skipping".format(from_path))
+          continue
+
+        locked_manifest[relative_absolute_path] = entry
+        self._copy_to_keybank(from_path, relative_absolute_path, entry, dry_run)
+        changed.append(relative_absolute_path)
+      elif relative_absolute_path in locked_manifest:
+        del locked_manifest[relative_absolute_path]
+        self.logger.info("{} no longer exists on the machine, deleting from keybank...".format(from_path))
+        if not dry_run and os.path.exists(self.keybank_path(relative_absolute_path)):
+          os.remove(self.keybank_path(relative_absolute_path))
+
+        changed.append(relative_absolute_path)
+
+    if changed and not dry_run:
+      self._write_locked_manifest(locked_manifest)
+      self.locked_manifest = locked_manifest
+
+    return changed
+
+  def manifest_entry_for(self, relative_absolute_path):
+    # Excluded paths are not covered by the manifest, nor is anything below
+    # an excluded directory.
+    prefix = ""
+    for name in relative_absolute_path.strip("/").split("/"):
+      prefix += "/" + name
+      if self.excludes.excluded(prefix, name):
+        return None
+
+    for entry in self.manifest:
+      if path_matches_glob(relative_absolute_path, "/" + entry["path"].lstrip("/")):
+        return entry
+
+    return None
+
+  def keybank_path(self, relative_absolute_path):
+    return os.path.join(self.path, relative_absolute_path.lstrip("/"))
+
+  # previous is the current lock entry of the file, if it is backed up.
+  def _lock_entry(self, from_path, on_read=None, previous=None):
+    stat = os.stat(from_path)
+    algorithm = lock_hash_algorithm(self.hash_algorithm, previous)
+    entry = {
+      "algorithm": algorithm,
+      "owner": getpwuid(stat.st_uid).pw_name,
+      "group": getgrgid(stat.st_gid).gr_name,
+    }
+
+    if self.chunk_size and stat.st_size > self.chunk_size:
+      entry["chunk_size"] = self.chunk_size
+      entry["size"] = stat.st_size
+      entry["chunks"] = hash_file_chunks(from_path, self.chunk_size, self.jobs, algorithm, on_read)
+      entry["hash"] = merkle_root(entry["chunks"], algorithm)
+    else:
+      entry["hash"] = hash_file(from_path, algorithm=algorithm, on_read=on_read)
+
+    return entry
+
+  def _relock_entry(self, from_path, previous):
+    # Like _lock_entry for a file that is already backed up, but hashed the
+    # way its previous entry was (algorithm and chunk size) instead of with
+    # the current settings, so an unchanged file gets an identical entry.
+    stat = os.stat(from_path)
+    entry = dict((key, previous[key]) for key in ("algorithm", "chunk_size") if key in previous)
+    entry["owner"] = getpwuid(stat.st_uid).pw_name
+    entry["group"] = getgrgid(stat.st_gid).gr_name
+    entry["hash"], chunks = self._hash_like_entry(from_path, previous)
+    if chunks is not None:
+      entry["size"] = stat.st_size
+      entry["chunks"] = chunks
+
+    return entry
+
+  def _hash_like_entry(self, path, entry, on_read=None):
+    # Hashes path the same way the lock entry was hashed during the backup.
+    # Returns the hash and, for chunked entries, the chunk hashes.
+    algorithm = entry.get("algorithm", LEGACY_HASH_ALGORITHM)
+    if "chunks" not in entry:
+      return hash_file(path, algorithm=algorithm, on_read=on_read), None
+
+    chunks = hash_file_chunks(path, entry["chunk_size"], self.jobs, algorithm, on_read)
+    return merkle_root(chunks, algorithm), chunks
+
+  def _differing_ranges(self, entry, actual_chunks, actual_size):
+    # Byte ranges (start, end) of the backed up file whose chunks do not match
+    # the lock entry. Consecutive bad chunks are merged into one range.
+    chunk_size = entry["chunk_size"]
+    ranges = []
+    for i in range(max(len(entry["chunks"]), len(actual_chunks))):
+      expected = entry["chunks"][i] if i < len(entry["chunks"]) else None
+      actual = actual_chunks[i] if i < len(actual_chunks) else None
+      if expected == actual:
+        continue
+
+      start = i * chunk_size
+      end = min(start + chunk_size, max(entry["size"], actual_size))
+      if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+      else:
+        ranges.append((start, end))
+
+    return ranges
+
+  def _copy_to_keybank(self, from_path, relative_absolute_path, entry, dry_run, on_read=None):
+    to_path = self.keybank_path(relative_absolute_path)
+    self.logger.info("copy {} to {} with hash {}".format(from_path, to_path, entry["hash"]))
 
-  def restore(self, to_directory, dry_run):
+    if not dry_run:
+      dirname = os.path.dirname(to_path)
+      mkdir_p(dirname)
+      copy_file(from_path, to_path, on_read=on_read)
+      os.chown(to_path, 0, 0)
+      os.chmod(to_path, int("0600", 8))
+
+  def _dump_locked_manifest(self, locked_manifest):
+    return json.dumps(locked_manifest, sort_keys=True, indent=4, separators=(",", ": "))
+
+  def _write_locked_manifest(self, locked_manifest):
+    with open(self.manifest_lock_path, "w") as f:
+      f.write(self._dump_locked_manifest(locked_manifest))
+
+  # only is an optional list of paths, globs or directories (as they are on
+  # the machine, i.e. the keys of the locked manifest) to restore instead of
+  # everything.
+  def restore(self, to_directory, dry_run, only=None):
+    report = self.restore_many([to_directory], dry_run, only=only)
+    failed = report.failed[to_directory]
+    if failed:
+      raise KeybankError("could not restore {} file(s) to {}, see messages above for details".format(len(failed), to_directory))
+
+    return report.restored[to_directory]
+
+  # Restores to several directories at once, e.g. the root filesystems of
+  # containers. Every file is read from the keybank once and written to all
+  # the directories in parallel. Owners and groups are mapped for each
+  # directory on its own, see OwnerMap. A failure only skips the file for the
+  # directory it happened in. Returns a RestoreReport.
+  def restore_many(self, to_directories, dry_run, only=None):
     self.logger.info("restoring generic files")
+    report = RestoreReport(restored=dict((d, []) for d in to_directories), failed=dict((d, {}) for d in to_directories))
     if not self.locked_manifest:
       self.logger.warning("empty or no manifest.json.lock file found, skipping generic files restore")
       self.logger.warning("this could be because the backup was not initialize or nothing is in the backup")
-      return True
+      return report
+
+    if only is None:
+      paths = sorted(self.locked_manifest)
+    else:
+      paths = self.lock_index().select(only)
+
+    progress = self.progress
+    if progress.enabled:
+      progress.start("restoring generic files", len(paths), self._keybank_size(paths))
+
+    nss_cache = {}
+    owner_maps = dict((d, OwnerMap(d, nss_cache)) for d in to_directories)
+    pool = ThreadPool(len(to_directories)) if len(to_directories) > 1 and not dry_run else None
+    try:
+      for path in paths:
+        self._restore_one(path, to_directories, owner_maps, dry_run, pool, report)
+        progress.file_done()
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+    progress.finish()
+    for to_directory in to_directories:
+      failed = report.failed[to_directory]
+      if failed:
+        self.logger.error("{}: {} restored, {} failed".format(to_directory, len(report.restored[to_directory]), len(failed)))
+
+    return report
+
+  def _restore_one(self, path, to_directories, owner_maps, dry_run, pool, report):
+    data = self.locked_manifest[path]
+    from_path = self.keybank_path(path)
+    owner, group = data["owner"], data["group"]
+
+    def fail(output, e):
+      self.logger.error("could not restore {} to {}: {}".format(path, output[0], e))
+      report.failed[output[0]][path] = str(e)
+      if output[5] is not None:
+        self._discard_restore_file(output[2], output[5])
+
+    # (to_directory, to_path, temporary path, owner id, group id, open
+    # temporary file) for every directory the file is still being written to.
+    # The file only replaces to_path once it is complete, so a failure leaves
+    # whatever was there before.
+    outputs = []
+    for to_directory in to_directories:
+      to_path = os.path.join(to_directory, path.lstrip("/"))
+      try:
+        owner_id = owner_maps[to_directory].uid(owner)
+        group_id = owner_maps[to_directory].gid(group)
+        self.logger.info("copy {} to {} with owner:group of {}({}):{}({})".format(from_path, to_path, owner, owner_id, group, group_id))
+        tmp_path, f = None, None
+        if not dry_run:
+          dirname = os.path.dirname(to_path)
+          mkdir_p(dirname)
+          os.chown(dirname, owner_id, group_id)
+          os.chmod(dirname, int("0700", 8))
+          tmp_path, f = self._open_restore_file(to_path)
+      except (KeybankError, IOError, OSError) as e:
+        fail((to_directory, to_path, None, None, None, None), e)
+        continue
+
+      outputs.append((to_directory, to_path, tmp_path, owner_id, group_id, f))
+
+    if not dry_run and outputs:
+      on_read = self.progress.add_bytes if self.progress.enabled else None
+      try:
+        with open(from_path, "rb") as src:
+          while outputs:
+            buf = src.read(2**20)
+            if not buf:
+              break
+
+            def write(output):
+              try:
+                output[5].write(buf)
+              except (IOError, OSError) as e:
+                return e
+
+            errors = pool.map(write, outputs) if pool is not None else [write(output) for output in outputs]
+            for output, e in zip(list(outputs), errors):
+              if e is not None:
+                fail(output, e)
+                outputs.remove(output)
+
+            if on_read is not None:
+              on_read(len(buf))
+      except (IOError, OSError) as e:
+        # reading the keybank failed, so this file failed everywhere
+        for output in outputs:
+          fail(output, e)
+
+        return
+
+    for output in outputs:
+      to_directory, to_path, tmp_path, owner_id, group_id, f = output
+      if f is not None:
+        try:
+          f.close()
+          shutil.copystat(from_path, tmp_path)
+          os.chown(tmp_path, owner_id, group_id)
+          os.chmod(tmp_path, int("0600", 8))
+          os.rename(tmp_path, to_path)
+        except (IOError, OSError) as e:
+          fail(output, e)
+          continue
+
+      report.restored[to_directory].append(path)
+
+  def _open_restore_file(self, to_path):
+    # A temporary file next to to_path, so it can be renamed over it.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(to_path), prefix="." + os.path.basename(to_path) + ".")
+    return tmp_path, os.fdopen(fd, "wb")
 
-    for path, data in self.locked_manifest.items():
-      path = path.lstrip("/")
-      from_path = os.path.join(self.path, path)
-      to_path = os.path.join(to_directory, path)
+  def _discard_restore_file(self, tmp_path, f):
+    try:
+      f.close()
+    except (IOError, OSError):
+      pass
 
-      owner, group = data["owner"], data["group"]
-      owner_id = getpwnam(owner).pw_uid
-      group_id = getgrnam(group).gr_gid
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
 
-      self.logger.info("copy {} to {} with owner:group of {}({}):{}({})".format(from_path, to_path, owner, owner_id, group, group_id))
-      if not dry_run:
-        dirname = os.path.dirname(to_path)
-        mkdir_p(dirname)
-        os.chown(dirname, owner_id, group_id)
-        os.chmod(dirname, int("0700", 8))
+  def lock_index(self):
+    if self._lock_index is None or self._lock_index.locked_manifest is not self.locked_manifest:
+      self._lock_index = LockIndex(self.locked_manifest)
 
-        shutil.copy2(from_path, to_path)
-        os.chown(to_path, owner_id, group_id)
-        os.chmod(to_path, int("0600", 8))
+    return self._lock_index
 
   def get_relative_absolute_path(self, path, root):
     path = path[len(root):]
@@ -179,7 +789,10 @@ class GenericFiles(object):
     path = "/" + path
     return path
 
-  def expand_path(self, path, base="/"):
+  def expand_path_pattern(self, path, base="/"):
     path = path.lstrip("/")
     path = os.path.join(base, path)
-    return glob.glob(os.path.expanduser(path))
+    return os.path.expanduser(path)
+
+  def expand_path(self, path, base="/"):
+    return glob_paths(base, path, self.excludes)
@@ -1,22 +1,42 @@
 from __future__ import absolute_import
 
 from contextlib import contextmanager
+import json
 import logging
 import os
+import shutil
 import subprocess
 
-from .utils import execute, mkdir_p
+from .progress import NO_PROGRESS
+from .utils import execute, hash_file, lock_hash_algorithm, mkdir_p, KeybankError
+
+
+# Only the files that make up the keyrings are backed up. Everything else in a
+# GNUPGHOME (sockets, random_seed, agent configs, lock files) is left alone.
+KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "secring.gpg", "trustdb.gpg"]
+KEYRING_DIRECTORIES = {
+  "private-keys-v1.d": ".key",
+  "openpgp-revocs.d": ".rev",
+}
 
 
 class GPGFiles(object):
   @staticmethod
   def initialize_directory_structure(keybank_partition_path):
     os.mkdir(os.path.join(keybank_partition_path, "gpg"))
+    with open(os.path.join(keybank_partition_path, "gpg", "manifest.json"), "w") as f:
+      f.write("{}")
 
   def __init__(self, path):
     self.logger = logging.getLogger("gpg")
     self.path = path
     self.export_path = os.path.join(self.path, "_export")
+    # Maps the name of a gnupg home in the keybank to its path on the machine
+    self.manifest_path = os.path.join(self.path, "manifest.json")
+    # see utils.lock_hash_algorithm
+    self.hash_algorithm = None
+    # see progress.Progress
+    self.progress = NO_PROGRESS
 
     self.gpg_homes = []
     self.scan()
@@ -81,7 +101,7 @@ class GPGFiles(object):
         break
 
     if master_keyid is None:
-      raise RuntimeError("could not find master key id")
+      raise KeybankError("could not find master key id")
 
     export_cmd = self._gpg_cmd(path, "--output {}/subkeys --export-options export-reset-subkey-passwd --export-secret-subkeys {}".format(export_path, master_keyid))
     import_cmd = self._gpg_cmd(export_path, "--import {}/subkeys".format(export_path))
@@ -110,9 +130,137 @@ class GPGFiles(object):
     self.logger.warning("=========")
     self.logger.warning("")
 
+  def load_manifest(self):
+    if not os.path.exists(self.manifest_path):
+      return {}
+
+    with open(self.manifest_path) as f:
+      manifest = json.load(f)
+
+    if not isinstance(manifest, dict):
+      raise KeybankError("gpg/manifest.json must contain a dict, not a {}".format(type(manifest)))
+
+    return manifest
+
+  def lock_path(self, name):
+    return os.path.join(self.path, "{}.json.lock".format(name))
+
+  def load_lock(self, name):
+    if not os.path.exists(self.lock_path(name)):
+      return {}
+
+    with open(self.lock_path(name)) as f:
+      return json.load(f)
+
+  def keyring_files(self, home):
+    # Yields the paths of the keyring files relative to the gnupg home.
+    for fn in KEYRING_FILES:
+      if os.path.isfile(os.path.join(home, fn)):
+        yield fn
+
+    for directory, extension in sorted(KEYRING_DIRECTORIES.items()):
+      path = os.path.join(home, directory)
+      if not os.path.isdir(path):
+        continue
+
+      for fn in sorted(os.listdir(path)):
+        if fn.endswith(extension) and os.path.isfile(os.path.join(path, fn)):
+          yield os.path.join(directory, fn)
+
   def backup(self, from_directory, dry_run):
-    with self._attention_banner():
-      self.logger.warning("gpg backend does not support backups... skipping")
+    manifest = self.load_manifest()
+    if not manifest:
+      with self._attention_banner():
+        self.logger.warning("no gnupg homes listed in gpg/manifest.json... skipping")
+        self.logger.warning("add entries like {\"johnsmith\": \"/home/johnsmith/.gnupg\"} to back them up")
+      return {}
+
+    homes = []
+    for name, home in sorted(manifest.items()):
+      home = os.path.join(from_directory, home.lstrip("/"))
+      if not os.path.isdir(home):
+        raise KeybankError("gnupg home {} for {} does not exist".format(home, name))
+
+      homes.append((name, home))
+
+    if self.progress.enabled:
+      paths = [os.path.join(home, fn) for _, home in homes for fn in self.keyring_files(home)]
+      self.progress.start("backing up gpg files", len(paths), sum(os.path.getsize(path) for path in paths))
+
+    changed = {}
+    for name, home in homes:
+      changed[name] = self._backup_one(name, home, dry_run)
+
+    self.progress.finish()
+    return changed
+
+  def _backup_one(self, name, home, dry_run):
+    # Only copies the keyring files whose content changed since the last
+    # backup, according to the per home lock file. The size and mtime are
+    # checked first so that unchanged files are not even hashed.
+    self.logger.info("backing up gnupg home {} to {}".format(home, name))
+    old_lock = self.load_lock(name)
+    lock = {}
+    changed = []
+    keybank_home = os.path.join(self.path, name)
+    on_read = self.progress.add_bytes if self.progress.enabled else None
+
+    for fn in self.keyring_files(home):
+      from_path = os.path.join(home, fn)
+      to_path = os.path.join(keybank_home, fn)
+      stat = os.stat(from_path)
+      previous = old_lock.get(fn)
+
+      if previous is not None and (previous["size"], previous["mtime"]) == (stat.st_size, stat.st_mtime) and os.path.isfile(to_path):
+        lock[fn] = previous
+        self.progress.file_done()
+        continue
+
+      algorithm = lock_hash_algorithm(self.hash_algorithm, previous)
+      entry = {
+        "algorithm": algorithm,
+        "hash": hash_file(from_path, algorithm=algorithm, on_read=on_read),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+      }
+      lock[fn] = entry
+
+      if previous is not None and previous["hash"] == entry["hash"] and os.path.isfile(to_path):
+        self.logger.debug("{} was touched but did not change".format(from_path))
+        self.progress.file_done()
+        continue
+
+      changed.append(fn)
+      self.logger.info("copy {} to {} with hash {}".format(from_path, to_path, entry["hash"]))
+      if not dry_run:
+        mkdir_p(os.path.dirname(to_path))
+        os.chmod(keybank_home, int("0700", 8))
+        os.chmod(os.path.dirname(to_path), int("0700", 8))
+        shutil.copy2(from_path, to_path)
+        os.chown(to_path, 0, 0)
+        os.chmod(to_path, int("0600", 8))
+
+      self.progress.file_done()
+
+    for fn in sorted(set(old_lock) - set(lock)):
+      changed.append(fn)
+      self.logger.info("{} no longer exists in {}, deleting...".format(fn, home))
+      to_path = os.path.join(keybank_home, fn)
+      if not dry_run and os.path.exists(to_path):
+        os.remove(to_path)
+
+    if lock != old_lock and not dry_run:
+      tmp_path = self.lock_path(name) + ".tmp"
+      with open(tmp_path, "w") as f:
+        f.write(json.dumps(lock, sort_keys=True, indent=4, separators=(",", ": ")))
+
+      os.rename(tmp_path, self.lock_path(name))
+
+    if not dry_run and name not in self.gpg_homes:
+      self.gpg_homes.append(name)
+
+    self.logger.info("{} keyring file(s) changed for {}".format(len(changed), name))
+    return changed
 
   def restore(self, to_directory, dry_run):
     with self._attention_banner():
@@ -120,6 +268,13 @@ class GPGFiles(object):
       self.logger.warning("it will restore inside the keybank, under the gpg/_export directory.")
       self.logger.warning("you will need to copy it manually for now.")
 
+    self.progress.start("exporting gpg homes", len(self.gpg_homes), unit="homes")
+    exported = {}
     for name in self.gpg_homes:
       path = self._export_subkeys(name, self.export_path, dry_run)
+      exported[name] = path
       self.logger.info("the copy of gnupg home of {} without the master key is available here: {}".format(name, path))
+      self.progress.file_done()
+
+    self.progress.finish()
+    return exported
@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+
+# Reports the progress of long operations: files and bytes done against the
+# planned totals, the current throughput and an ETA. On a terminal a status
+# line is redrawn in place, otherwise a log line is written every so often.
+# add_bytes is called by the copy and hash loops for every piece they read, so
+# it only does the bookkeeping and leaves the reporting to the next interval.
+
+import logging
+import sys
+import threading
+import time
+
+
+TTY_INTERVAL = 0.2
+LOG_INTERVAL = 10.0
+RATE_WINDOW = 1.0
+
+
+def format_bytes(amount):
+  for unit in ("B", "KB", "MB", "GB"):
+    if amount < 1000:
+      return "{:.1f} {}".format(amount, unit) if unit != "B" else "{} B".format(int(amount))
+    amount /= 1000.0
+
+  return "{:.1f} TB".format(amount)
+
+
+def format_duration(seconds):
+  seconds = int(seconds)
+  return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class NullProgress(object):
+  # Does nothing, for when progress is not reported.
+  enabled = False
+
+  def start(self, label, total_files, total_bytes=None, unit="files"):
+    pass
+
+  def add_bytes(self, amount):
+    pass
+
+  def file_done(self):
+    pass
+
+  def finish(self):
+    pass
+
+
+NO_PROGRESS = NullProgress()
+
+
+class _ClearStatusLine(logging.Filter):
+  # Log records would be printed right after the status line, so it is
+  # cleared first and redrawn with the next update.
+  def __init__(self, progress):
+    logging.Filter.__init__(self)
+    self.progress = progress
+
+  def filter(self, record):
+    self.progress.clear()
+    return True
+
+
+class Progress(object):
+  enabled = True
+
+  # tty decides between redrawing a status line and writing log lines. None
+  # picks the status line if stream is a terminal.
+  def __init__(self, stream=None, tty=None, interval=None):
+    self.logger = logging.getLogger()
+    self.stream = stream or sys.stderr
+    if tty is None:
+      tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+
+    self.tty = tty
+    self.interval = interval if interval is not None else (TTY_INTERVAL if tty else LOG_INTERVAL)
+    self._lock = threading.Lock()
+    self._filter = _ClearStatusLine(self)
+    self._shown = False
+    self.label = None
+
+  def start(self, label, total_files, total_bytes=None, unit="files"):
+    # Starts reporting a new phase of an operation. total_bytes is None when
+    # the size of the work is unknown.
+    now = time.time()
+    self.label = label
+    self.unit = unit
+    self.total_files = total_files
+    self.total_bytes = total_bytes
+    self.files_done = 0
+    self.bytes_done = 0
+    self.started_at = now
+    self._next_report = now + self.interval
+    self._last_report = (now, 0)
+    self.rate = 0.0
+    if self.tty:
+      for handler in logging.getLogger().handlers:
+        handler.addFilter(self._filter)
+
+  def add_bytes(self, amount):
+    with self._lock:
+      self.bytes_done += amount
+      now = time.time()
+      if now < self._next_report:
+        return
+
+      self._next_report = now + self.interval
+
+    self.report(now)
+
+  def file_done(self):
+    with self._lock:
+      self.files_done += 1
+      now = time.time()
+      if now < self._next_report:
+        return
+
+      self._next_report = now + self.interval
+
+    self.report(now)
+
+  def status(self, now=None):
+    now = now or time.time()
+    parts = ["{}/{} {}".format(self.files_done, self.total_files, self.unit)]
+    if self.total_bytes is not None:
+      parts.append("{} of {}".format(format_bytes(self.bytes_done), format_bytes(self.total_bytes)))
+
+    if self.bytes_done:
+      parts.append("{}/s".format(format_bytes(self.rate)))
+
+    eta = self.eta(now)
+    if eta is not None:
+      parts.append("ETA {}".format(format_duration(eta)))
+
+    return "{}: {}".format(self.label, ", ".join(parts))
+
+  def eta(self, now):
+    # Based on the average since the start, which is steadier than the
+    # current rate.
+    elapsed = now - self.started_at
+    if self.total_bytes and self.bytes_done:
+      return elapsed * (self.total_bytes - self.bytes_done) / self.bytes_done
+
+    if self.total_files and self.files_done:
+      return elapsed * (self.total_files - self.files_done) / self.files_done
+
+    return None
+
+  def report(self, now):
+    # The current rate is measured over at least RATE_WINDOW seconds, reports
+    # can come right after each other when files are done.
+    last_at, last_bytes = self._last_report
+    if now - last_at >= RATE_WINDOW:
+      self.rate = (self.bytes_done - last_bytes) / (now - last_at)
+      self._last_report = (now, self.bytes_done)
+    elif now > self.started_at and not self.rate:
+      self.rate = self.bytes_done / (now - self.started_at)
+
+    if self.tty:
+      self.stream.write("\r\033[K" + self.status(now))
+      self.stream.flush()
+      self._shown = True
+    else:
+      self.logger.info(self.status(now))
+
+  def clear(self):
+    if self._shown:
+      self.stream.write("\r\033[K")
+      self.stream.flush()
+      self._shown = False
+
+  def finish(self):
+    self.clear()
+    if self.tty:
+      for handler in logging.getLogger().handlers:
+        handler.removeFilter(self._filter)
+
+    elapsed = time.time() - self.started_at
+    message = "{}: {} {}".format(self.label, self.files_done, self.unit)
+    if self.bytes_done:
+      message += ", {} in {} ({}/s)".format(format_bytes(self.bytes_done), format_duration(elapsed), format_bytes(self.bytes_done / max(elapsed, 1e-6)))
+
+    self.logger.info(message)
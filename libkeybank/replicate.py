@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+
+# Replicates a detached keybank file (the LUKS ciphertext) to another file by
+# only rewriting the blocks that changed since the last replication. Changes
+# are detected by comparing the hashes of the source blocks with a block map
+# saved next to the destination, so the keybank never has to be decrypted.
+
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+
+from .utils import new_hash, DEFAULT_HASH_ALGORITHM
+
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+BLOCK_MAP_SUFFIX = ".blockmap"
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+ReplicateReport = namedtuple("ReplicateReport", ["blocks", "copied", "bytes_copied", "full_scan"])
+
+
+def _data_ranges(f, size):
+  # Yields the (start, end) ranges of f that contain data. Holes of sparse
+  # files are skipped without reading them when the OS supports SEEK_DATA.
+  if not hasattr(os, "SEEK_DATA"):
+    yield 0, size
+    return
+
+  fd = f.fileno()
+  offset = 0
+  while offset < size:
+    try:
+      start = os.lseek(fd, offset, os.SEEK_DATA)
+    except OSError as e:
+      if e.errno != errno.ENXIO:
+        # Not supported here, so everything has to be read.
+        yield offset, size
+      # ENXIO: there is no more data after offset.
+      return
+
+    end = os.lseek(fd, start, os.SEEK_HOLE)
+    yield start, min(end, size)
+    offset = end
+
+
+def _punch_hole(f, offset, length):
+  libc_name = ctypes.util.find_library("c")
+  if libc_name is None:
+    return False
+
+  libc = ctypes.CDLL(libc_name, use_errno=True)
+  fallocate = libc.fallocate
+  fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+  return fallocate(f.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class BlockReplicator(object):
+  def __init__(self, src, dest, block_size=DEFAULT_BLOCK_SIZE, map_path=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    self.logger = logging.getLogger()
+    self.src = src
+    self.dest = dest
+    self.block_size = block_size
+    self.map_path = map_path or dest + BLOCK_MAP_SUFFIX
+    self.algorithm = algorithm
+    self.zero_block = b"\0" * block_size
+
+  def block_hashes(self, f, size):
+    # Hashes every block of f. All zero blocks (including holes) are recorded
+    # as None so they can be kept sparse.
+    hashes = [None] * ((size + self.block_size - 1) // self.block_size)
+    for start, end in _data_ranges(f, size):
+      first = start // self.block_size
+      last = (end - 1) // self.block_size
+      for i in range(first, last + 1):
+        if hashes[i] is not None:
+          continue
+
+        f.seek(i * self.block_size)
+        hashes[i] = self._hash_block(f.read(self.block_size))
+
+    return hashes
+
+  def _hash_block(self, buf):
+    if buf == self.zero_block[:len(buf)]:
+      return None
+
+    h = new_hash(self.algorithm)
+    h.update(buf)
+    return h.hexdigest()
+
+  def load_block_map(self):
+    # The saved block map is only trusted if it matches the destination as it
+    # was left by the last replication.
+    try:
+      with open(self.map_path) as f:
+        block_map = json.load(f)
+      dest_stat = os.stat(self.dest)
+    except (IOError, OSError, ValueError):
+      return None
+
+    expected = (self.block_size, self.algorithm, dest_stat.st_size, dest_stat.st_mtime)
+    actual = (block_map.get("block_size"), block_map.get("algorithm"), block_map.get("size"), block_map.get("mtime"))
+    if expected != actual:
+      self.logger.warning("block map {} does not match {}, rescanning the destination".format(self.map_path, self.dest))
+      return None
+
+    return block_map["hashes"]
+
+  def save_block_map(self, hashes):
+    dest_stat = os.stat(self.dest)
+    block_map = {
+      "block_size": self.block_size,
+      "algorithm": self.algorithm,
+      "size": dest_stat.st_size,
+      "mtime": dest_stat.st_mtime,
+      "hashes": hashes,
+    }
+
+    tmp_path = self.map_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(block_map, f)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.rename(tmp_path, self.map_path)
+
+  def replicate(self, dry_run=False):
+    size = os.path.getsize(self.src)
+    full_scan = False
+    if os.path.exists(self.dest):
+      dest_hashes = self.load_block_map()
+      if dest_hashes is None:
+        full_scan = True
+        with open(self.dest, "rb") as f:
+          dest_hashes = self.block_hashes(f, os.path.getsize(self.dest))
+    else:
+      self.logger.info("{} does not exist, creating it as a sparse file".format(self.dest))
+      # Everything in the new file will be a hole, i.e. read as zeros.
+      dest_hashes = []
+      if not dry_run:
+        open(self.dest, "wb").close()
+
+    copied = 0
+    bytes_copied = 0
+    with open(self.src, "rb") as src:
+      src_hashes = self.block_hashes(src, size)
+      with open(self.dest, "r+b") if not dry_run else open(os.devnull, "wb") as dest:
+        if not dry_run:
+          dest.truncate(size)
+
+        for i, src_hash in enumerate(src_hashes):
+          # Anything past the old end of the destination was zero filled by
+          # the truncate above.
+          dest_hash = dest_hashes[i] if i < len(dest_hashes) else None
+          if dest_hash == src_hash:
+            continue
+
+          offset = i * self.block_size
+          length = min(self.block_size, size - offset)
+          copied += 1
+          if src_hash is None:
+            self.logger.debug("block {} became empty, punching a hole".format(i))
+            if not dry_run:
+              dest.flush()
+
+            if not dry_run and not _punch_hole(dest, offset, length):
+              dest.seek(offset)
+              dest.write(self.zero_block[:length])
+          else:
+            self.logger.debug("copying block {} ({} bytes at {})".format(i, length, offset))
+            bytes_copied += length
+            if not dry_run:
+              src.seek(offset)
+              dest.seek(offset)
+              dest.write(src.read(length))
+
+        if not dry_run:
+          dest.flush()
+          os.fsync(dest.fileno())
+
+    if not dry_run:
+      self.save_block_map(src_hashes)
+
+    self.logger.info("{} of {} blocks changed, {} bytes copied".format(copied, len(src_hashes), bytes_copied))
+    return ReplicateReport(blocks=len(src_hashes), copied=copied, bytes_copied=bytes_copied, full_scan=full_scan)
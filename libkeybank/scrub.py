@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+
+# Verifies the generic files of a keybank a little at a time. Reads are
+# throttled to a bytes per second cap and the progress is checkpointed in a
+# state file inside the keybank, so a full pass can be spread over many short
+# runs that each pick up where the last one stopped.
+
+from bisect import bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from .generic_files import VERIFIED
+from .utils import KeybankScrubInProgressError
+
+
+SCRUB_STATE_FILE = "scrub.json"
+
+# How often the progress is written to the state file while scrubbing.
+CHECKPOINT_INTERVAL = 10.0
+
+ScrubReport = namedtuple("ScrubReport", ["verified", "differences", "bytes_read", "complete"])
+
+
+class RateLimiter(object):
+  # Sleeps in consume whenever more than rate bytes per second were consumed
+  # on average. At most a second worth of unused budget is carried over, so
+  # a pause does not turn into a burst afterwards.
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.start = time.time()
+    self.consumed = 0
+    self._lock = threading.Lock()
+
+  def consume(self, amount):
+    with self._lock:
+      self.consumed += amount
+      delay = self.consumed / self.rate - (time.time() - self.start)
+      if delay < -1.0:
+        self.start += -delay - 1.0
+        delay = -1.0
+
+    if delay > 0:
+      time.sleep(delay)
+
+
+class Scrubber(object):
+  def __init__(self, files, state_path, rate=None):
+    self.logger = logging.getLogger()
+    self.files = files
+    self.state_path = state_path
+    self.rate = rate
+
+  def load_state(self):
+    # cursor is the last file verified by the current pass, None when the
+    # next run starts a new pass. files records when every file was last
+    # verified and how that went.
+    state = {"cursor": None, "pass_started_at": None, "last_pass_completed_at": None, "files": {}}
+    try:
+      with open(self.state_path) as f:
+        state.update(json.load(f))
+    except IOError:
+      pass
+    except ValueError:
+      self.logger.warning("{} is corrupted, starting a new scrub pass".format(self.state_path))
+
+    return state
+
+  def save_state(self, state):
+    tmp_path = self.state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(state, f, indent=2, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.rename(tmp_path, self.state_path)
+
+  @contextmanager
+  def _only_scrub(self):
+    # Verify and friends only need the shared keybank lock, but two scrubs
+    # would both write the state file and together read faster than the
+    # rate. So scrubs exclude each other with a lock of their own, without
+    # waiting: the running scrub already does the work.
+    with open(self.state_path + ".lock", "a") as f:
+      try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+          raise KeybankScrubInProgressError("another scrub of this keybank is already running")
+        raise
+
+      yield
+
+  def run(self, max_bytes=None, max_seconds=None):
+    # Verifies files in path order until the pass is complete or max_bytes
+    # were read or max_seconds passed. A file that was started is always
+    # finished, so every run makes progress. Raises
+    # KeybankScrubInProgressError if another scrub is running.
+    with self._only_scrub():
+      return self._run(max_bytes, max_seconds)
+
+  def _run(self, max_bytes, max_seconds):
+    state = self.load_state()
+    paths = self.files.lock_index().sorted_paths
+    if state["cursor"] is None:
+      state["pass_started_at"] = time.time()
+      start = 0
+    else:
+      start = bisect_right(paths, state["cursor"])
+      self.logger.info("resuming scrub pass after {}".format(state["cursor"]))
+
+    limiter = RateLimiter(self.rate) if self.rate else None
+    bytes_read = [0]
+    bytes_read_lock = threading.Lock()
+
+    # called from the hashing threads of chunked files
+    def on_read(amount):
+      with bytes_read_lock:
+        bytes_read[0] += amount
+
+      if limiter is not None:
+        limiter.consume(amount)
+
+    verified = 0
+    differences = {}
+    complete = False
+    started_at = last_checkpoint_at = time.time()
+    try:
+      for fn in paths[start:]:
+        if max_bytes is not None and bytes_read[0] >= max_bytes:
+          break
+
+        if max_seconds is not None and time.time() - started_at >= max_seconds:
+          break
+
+        result = self.files.verify_path(fn, on_read)
+        if result.status == VERIFIED:
+          verified += 1
+        else:
+          differences[fn] = result
+
+        state["files"][fn] = {"verified_at": time.time(), "status": result.status}
+        state["cursor"] = fn
+        if time.time() - last_checkpoint_at >= CHECKPOINT_INTERVAL:
+          self.save_state(state)
+          last_checkpoint_at = time.time()
+      else:
+        complete = True
+
+      if complete:
+        state["cursor"] = None
+        state["last_pass_completed_at"] = time.time()
+        # forget about files that are no longer backed up
+        state["files"] = dict((fn, v) for fn, v in state["files"].items() if fn in self.files.locked_manifest)
+    finally:
+      self.save_state(state)
+
+    if complete:
+      self.logger.info("scrub pass complete, {} files verified, {} bytes read".format(verified, bytes_read[0]))
+    else:
+      self.logger.info("scrub stopped at {}, {} bytes read, the next run resumes from here".format(state["cursor"], bytes_read[0]))
+
+    return ScrubReport(verified=verified, differences=differences, bytes_read=bytes_read[0], complete=complete)
@@ -1,15 +1,42 @@
 from __future__ import print_function
 
+from binascii import unhexlify
 from contextlib import contextmanager
 import errno
+import fnmatch
 import hashlib
 import logging
 import os
+import shutil
 import subprocess
 import sys
 
 
-class SystemExecuteError(RuntimeError):
+class KeybankError(RuntimeError):
+  pass
+
+
+class KeybankNotAttachedError(KeybankError):
+  pass
+
+
+class KeybankAlreadyAttachedError(KeybankError):
+  pass
+
+
+class KeybankLockTimeoutError(KeybankError):
+  pass
+
+
+class KeybankReadOnlyError(KeybankError):
+  pass
+
+
+class KeybankScrubInProgressError(KeybankError):
+  pass
+
+
+class SystemExecuteError(KeybankError):
   pass
 
 
@@ -28,8 +55,18 @@ def execute(command, logger=None, raises=True):
     return status
 
 
-def quiet_call(command):
-  return subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, "wb"))
+def quiet_call(args):
+  with open(os.devnull, "wb") as devnull:
+    return subprocess.call(args, stdout=devnull, stderr=devnull)
+
+
+def which(name):
+  for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+
+  return None
 
 
 @contextmanager
@@ -52,13 +89,146 @@ def mkdir_p(path):
       raise
 
 
-def hash_file(path, chunk_size=2**20):
-  h = hashlib.sha256()
+# Lock entries written before the algorithm was recorded are always sha256.
+LEGACY_HASH_ALGORITHM = "sha256"
+
+HASH_ALGORITHMS = [a for a in ("blake2b", "blake2s", "sha256", "sha512") if hasattr(hashlib, a)]
+
+# blake2b is considerably faster than sha256 on CPUs without SHA extensions.
+DEFAULT_HASH_ALGORITHM = "blake2b" if "blake2b" in HASH_ALGORITHMS else "sha256"
+
+
+def new_hash(algorithm=LEGACY_HASH_ALGORITHM):
+  # Locks written by a newer python can use algorithms this one lacks (e.g.
+  # blake2b on python 2).
+  if algorithm not in HASH_ALGORITHMS:
+    raise KeybankError("hash algorithm {} is not supported by this python, only {}".format(algorithm, ", ".join(HASH_ALGORITHMS)))
+
+  return getattr(hashlib, algorithm)()
+
+
+def lock_hash_algorithm(chosen, previous):
+  # The algorithm to lock a file with. chosen (e.g. --hash-algo) applies to
+  # every file. Otherwise a file that is already backed up keeps the
+  # algorithm of its previous lock entry, so the lock only changes where the
+  # files did, and new files get the default.
+  if chosen is not None:
+    return chosen
+
+  if previous is None:
+    return DEFAULT_HASH_ALGORITHM
+
+  algorithm = previous.get("algorithm", LEGACY_HASH_ALGORITHM)
+  return algorithm if algorithm in HASH_ALGORITHMS else DEFAULT_HASH_ALGORITHM
+
+
+# on_read, if given, is called with the size of every piece read from the
+# file, e.g. to throttle or report the reads.
+def hash_file(path, chunk_size=2**20, algorithm=LEGACY_HASH_ALGORITHM, on_read=None):
+  h = new_hash(algorithm)
   with open(path, "rb") as f:
     while True:
       buf = f.read(chunk_size)
       if not buf:
         break
       h.update(buf)
+      if on_read is not None:
+        on_read(len(buf))
 
   return h.hexdigest()
+
+
+def copy_file(from_path, to_path, chunk_size=2**20, on_read=None):
+  # shutil.copy2, but reporting every piece copied to on_read.
+  if on_read is None:
+    shutil.copy2(from_path, to_path)
+    return
+
+  with open(from_path, "rb") as src, open(to_path, "wb") as dest:
+    while True:
+      buf = src.read(chunk_size)
+      if not buf:
+        break
+      dest.write(buf)
+      on_read(len(buf))
+
+  shutil.copystat(from_path, to_path)
+
+
+def hash_file_range(path, offset, length, chunk_size=2**20, algorithm=LEGACY_HASH_ALGORITHM, on_read=None):
+  h = new_hash(algorithm)
+  with open(path, "rb") as f:
+    f.seek(offset)
+    while length > 0:
+      buf = f.read(min(chunk_size, length))
+      if not buf:
+        break
+      h.update(buf)
+      length -= len(buf)
+      if on_read is not None:
+        on_read(len(buf))
+
+  return h.hexdigest()
+
+
+def hash_file_chunks(path, chunk_size, jobs=1, algorithm=LEGACY_HASH_ALGORITHM, on_read=None):
+  # Hashes every chunk_size sized piece of the file independently so that
+  # the pieces of one large file can be hashed in parallel. on_read is called
+  # from all the threads.
+  size = os.path.getsize(path)
+  offsets = list(range(0, size, chunk_size))
+
+  def hash_chunk(offset):
+    return hash_file_range(path, offset, chunk_size, algorithm=algorithm, on_read=on_read)
+
+  if jobs <= 1 or len(offsets) <= 1:
+    return [hash_chunk(offset) for offset in offsets]
+
+  # multiprocessing is slow to import and rarely needed, see cmds
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(min(jobs, len(offsets)))
+  try:
+    return pool.map(hash_chunk, offsets)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def merkle_root(chunk_hashes, algorithm=LEGACY_HASH_ALGORITHM):
+  # Leaves are the plain chunk hashes, inner nodes are prefixed with \x01 so
+  # that they can never collide with a leaf. An odd node is carried up as is.
+  if not chunk_hashes:
+    return new_hash(algorithm).hexdigest()
+
+  level = list(chunk_hashes)
+  while len(level) > 1:
+    next_level = []
+    for i in range(0, len(level) - 1, 2):
+      h = new_hash(algorithm)
+      h.update(b"\x01" + unhexlify(level[i]) + unhexlify(level[i + 1]))
+      next_level.append(h.hexdigest())
+
+    if len(level) % 2 == 1:
+      next_level.append(level[-1])
+
+    level = next_level
+
+  return level[0]
+
+
+def path_matches_glob(path, pattern):
+  # Unlike fnmatch, glob wildcards never cross a "/" and never match a leading
+  # ".", so match each component separately the way glob.glob would.
+  path_parts = path.rstrip("/").split("/")
+  pattern_parts = pattern.rstrip("/").split("/")
+  if len(path_parts) != len(pattern_parts):
+    return False
+
+  for part, pattern_part in zip(path_parts, pattern_parts):
+    if part.startswith(".") and not pattern_part.startswith("."):
+      return False
+
+    if not fnmatch.fnmatchcase(part, pattern_part):
+      return False
+
+  return True
@@ -0,0 +1,206 @@
+from __future__ import absolute_import
+
+# Directory walking shared by the keybank scans and the expansion of the
+# manifest.json globs. Built on os.scandir so the file type comes from the
+# directory entry (d_type) and regular files and directories need no stat.
+# Excluded directories are pruned before they are entered.
+
+import fnmatch
+import os
+import re
+import stat
+
+try:
+  from os import scandir
+except ImportError:  # python < 3.5
+  scandir = None
+
+
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def _glob_to_regex(pattern):
+  # Like fnmatch.translate, but wildcards do not match "/" (glob semantics).
+  regex = []
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    i += 1
+    if c == "*":
+      regex.append("[^/]*")
+    elif c == "?":
+      regex.append("[^/]")
+    elif c == "[":
+      # a "]" right after the "[" (or "[!") is part of the set
+      start = i + 1 if pattern[i:i + 1] == "!" else i
+      end = pattern.find("]", start + 1)
+      if end == -1:
+        regex.append("\\[")
+        continue
+
+      body = pattern[i:end].replace("\\", "\\\\")
+      i = end + 1
+      if body.startswith("!"):
+        body = "^" + body[1:]
+      elif body.startswith("^"):
+        body = "\\" + body
+
+      regex.append("[" + body + "]")
+    else:
+      regex.append(re.escape(c))
+
+  return "".join(regex) + "\\Z"
+
+
+class ExcludeRules(object):
+  # Patterns without a "/" are matched against the name of every file and
+  # directory (e.g. "*.lock", "cache"). Patterns with a "/" are matched
+  # against the whole path relative to the walked base (e.g. "/home/*/.cache").
+  # All patterns are compiled into two regexes.
+  def __init__(self, patterns=()):
+    self.patterns = list(patterns)
+    name_patterns = [p for p in self.patterns if "/" not in p]
+    path_patterns = ["/" + p.lstrip("/") for p in self.patterns if "/" in p]
+    self._names = self._compile([fnmatch.translate(p) for p in name_patterns])
+    self._paths = self._compile([_glob_to_regex(p) for p in path_patterns])
+
+  @staticmethod
+  def _compile(regexes):
+    if not regexes:
+      return None
+
+    return re.compile("|".join("(?:{})".format(r) for r in regexes))
+
+  @classmethod
+  def from_manifest(cls, manifest):
+    return cls([entry["exclude"] for entry in manifest if "exclude" in entry])
+
+  def excluded(self, relative_absolute_path, name):
+    if self._names is not None and self._names.match(name):
+      return True
+
+    return self._paths is not None and self._paths.match(relative_absolute_path) is not None
+
+
+NO_EXCLUDES = ExcludeRules()
+
+
+class _Entry(object):
+  # Minimal os.DirEntry stand in for pythons without os.scandir.
+  def __init__(self, directory, name):
+    self.name = name
+    self.path = os.path.join(directory, name)
+    self._lstat = os.lstat(self.path)
+
+  def is_symlink(self):
+    return stat.S_ISLNK(self._lstat.st_mode)
+
+  def is_dir(self, follow_symlinks=True):
+    if follow_symlinks and self.is_symlink():
+      return os.path.isdir(self.path)
+    return stat.S_ISDIR(self._lstat.st_mode)
+
+  def is_file(self, follow_symlinks=True):
+    if follow_symlinks and self.is_symlink():
+      return os.path.isfile(self.path)
+    return stat.S_ISREG(self._lstat.st_mode)
+
+
+def _scandir(path):
+  if scandir is not None:
+    it = scandir(path)
+    try:
+      return list(it)
+    finally:
+      if hasattr(it, "close"):
+        it.close()
+
+  return [_Entry(path, name) for name in os.listdir(path)]
+
+
+def walk_files(base, excludes=NO_EXCLUDES, _relative=""):
+  # Yields (relative absolute path, path) for every regular file (or symlink
+  # to one) under base, in the order sorted() would put the paths in.
+  # Directories sort as if their name ended with a "/", so their contents are
+  # yielded exactly where they belong, which keeps the output sorted without
+  # ever holding more than the directories currently being walked. Symlinks
+  # to directories are not followed and sockets, fifos and devices are
+  # skipped.
+  entries = []
+  for entry in _scandir(base):
+    relative_absolute_path = _relative + "/" + entry.name
+    if excludes.excluded(relative_absolute_path, entry.name):
+      continue
+
+    if entry.is_dir(follow_symlinks=False):
+      entries.append((entry.name + "/", entry, True))
+    elif entry.is_file():
+      entries.append((entry.name, entry, False))
+
+  entries.sort(key=lambda e: e[0])
+  for _, entry, is_dir in entries:
+    relative_absolute_path = _relative + "/" + entry.name
+    if is_dir:
+      for item in walk_files(entry.path, excludes, relative_absolute_path):
+        yield item
+    else:
+      yield relative_absolute_path, entry.path
+
+
+def glob_paths(base, pattern, excludes=NO_EXCLUDES):
+  # Expands a glob (relative to base) like glob.glob would, but directory by
+  # directory with scandir, so excluded paths are never descended into.
+  # Only matches regular files (or symlinks to them): sockets, fifos and
+  # devices can not be backed up. Returns the matches sorted.
+  return _glob_sorted(base, pattern, excludes, False)
+
+
+def glob_directories(base, pattern, excludes=NO_EXCLUDES):
+  # Like glob_paths, but only matches directories.
+  return _glob_sorted(base, pattern, excludes, True)
+
+
+def _glob_sorted(base, pattern, excludes, directories):
+  parts = [part for part in pattern.strip("/").split("/") if part]
+  results = []
+  _glob(base.rstrip("/") or "/", "", parts, excludes, directories, results)
+  return sorted(results)
+
+
+def _glob(directory, relative, parts, excludes, directories, results):
+  if not parts:
+    return
+
+  part, rest = parts[0], parts[1:]
+  want_dir = bool(rest) or directories
+
+  if GLOB_MAGIC.search(part) is None:
+    path = os.path.join(directory, part)
+    if not (os.path.isdir(path) if want_dir else os.path.isfile(path)):
+      return
+
+    candidates = [(part, path)]
+  else:
+    try:
+      entries = _scandir(directory)
+    except OSError:
+      return
+
+    candidates = []
+    for entry in entries:
+      # like glob, wildcards do not match hidden files
+      if entry.name.startswith(".") and not part.startswith("."):
+        continue
+
+      if fnmatch.fnmatchcase(entry.name, part) and (entry.is_dir() if want_dir else entry.is_file()):
+        candidates.append((entry.name, entry.path))
+
+  for name, path in candidates:
+    relative_absolute_path = relative + "/" + name
+    if excludes.excluded(relative_absolute_path, name):
+      continue
+
+    if rest:
+      _glob(path, relative_absolute_path, rest, excludes, directories, results)
+    else:
+      results.append(path)
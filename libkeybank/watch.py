@@ -0,0 +1,262 @@
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from .walk import glob_directories, GLOB_MAGIC
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+@contextmanager
+def _no_lock():
+  yield
+
+
+class Inotify(object):
+  def __init__(self):
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+      raise OSError("cannot find libc, inotify is not available")
+
+    self._libc = ctypes.CDLL(libc_name, use_errno=True)
+    self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+    if self.fd < 0:
+      self._raise_errno("inotify_init1")
+
+    self.watches = {}
+
+  def _raise_errno(self, what, path=None):
+    code = ctypes.get_errno()
+    raise OSError(code, "{} failed: {}".format(what, os.strerror(code)), path)
+
+  def add_watch(self, path, mask=WATCH_MASK):
+    encoded_path = path.encode("utf-8") if not isinstance(path, bytes) else path
+    wd = self._libc.inotify_add_watch(self.fd, encoded_path, mask)
+    if wd < 0:
+      self._raise_errno("inotify_add_watch", path)
+
+    self.watches[wd] = path
+    return wd
+
+  def remove_watch(self, wd):
+    # A directory that was moved away keeps its watch (only deleted ones lose
+    # it), so its events would still be reported under the old path.
+    path = self.watches.pop(wd, None)
+    if self._libc.inotify_rm_watch(self.fd, wd) < 0 and ctypes.get_errno() != errno.EINVAL:
+      self._raise_errno("inotify_rm_watch", path)
+
+  def read_events(self, timeout):
+    # Yields (wd, mask, path) tuples. path is None for events on the watched
+    # directory itself.
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return
+
+    try:
+      buf = os.read(self.fd, 64 * 1024)
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        return
+      raise
+
+    offset = 0
+    while offset < len(buf):
+      wd, mask, _, name_length = _EVENT_HEADER.unpack_from(buf, offset)
+      offset += _EVENT_HEADER.size
+      name = buf[offset:offset + name_length].rstrip(b"\0").decode("utf-8", "replace")
+      offset += name_length
+
+      directory = self.watches.get(wd)
+      if mask & IN_IGNORED:
+        self.watches.pop(wd, None)
+
+      if directory is None:
+        yield wd, mask, None
+      else:
+        yield wd, mask, os.path.join(directory, name) if name else None
+
+  def close(self):
+    os.close(self.fd)
+
+
+class ManifestWatcher(object):
+  # lock, if given, is called for a context manager to hold while a batch of
+  # changes is backed up, see KeybankFS.lock.
+  def __init__(self, files, from_directory, debounce=2.0, max_delay=30.0, dry_run=False, lock=None):
+    self.logger = logging.getLogger()
+    self.files = files
+    self.from_directory = from_directory
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.dry_run = dry_run
+    self.lock = lock or _no_lock
+
+    self.inotify = None
+    self.pending = set()
+    self.has_pending = False
+    self.first_pending_at = None
+    self.last_event_at = None
+
+  def watched_directories(self):
+    # The directories the manifest globs match files in, plus those in which
+    # a directory they would match can still appear: the parents of globbed
+    # components (e.g. live/ for live/*/cert.pem) and the nearest existing
+    # ancestor of a directory that does not exist yet.
+    directories = set()
+    for entry in self.files.manifest:
+      parts = [part for part in entry["path"].strip("/").split("/") if part][:-1]
+      level = [self.from_directory]
+      for i, part in enumerate(parts):
+        next_level = glob_directories(self.from_directory, "/".join(parts[:i + 1]), self.files.excludes)
+        for directory in level:
+          if GLOB_MAGIC.search(part) is not None or os.path.join(directory, part) not in next_level:
+            directories.add(os.path.normpath(directory))
+
+        level = next_level
+
+      directories.update(os.path.normpath(directory) for directory in level)
+
+    return directories
+
+  def update_watches(self):
+    # Returns the directories that are newly watched.
+    wanted = self.watched_directories()
+    watched = dict((path, wd) for wd, path in self.inotify.watches.items())
+    for directory in sorted(set(watched) - wanted):
+      self.inotify.remove_watch(watched[directory])
+      self.logger.info("no longer watching {}".format(directory))
+
+    added = []
+    for directory in sorted(wanted - set(watched)):
+      try:
+        self.inotify.add_watch(directory)
+        self.logger.info("watching {}".format(directory))
+        added.append(directory)
+      except OSError as e:
+        self.logger.warning("cannot watch {}: {}".format(directory, e))
+
+    return added
+
+  def run(self):
+    self.inotify = Inotify()
+    try:
+      self.update_watches()
+      if not self.inotify.watches:
+        self.logger.warning("manifest.json has no paths to watch")
+
+      self.logger.info("waiting for changes (debounce {}s)".format(self.debounce))
+      while True:
+        self.poll()
+    finally:
+      self.inotify.close()
+      self.inotify = None
+
+  # Waits for events and backs up what changed once things settle down.
+  # max_wait limits the wait when nothing is pending, None waits forever.
+  def poll(self, max_wait=None):
+    timeout = max_wait
+    if self.has_pending:
+      timeout = max(0, self.debounce - (time.time() - self.last_event_at))
+
+    for wd, mask, path in self.inotify.read_events(timeout):
+      if mask & IN_Q_OVERFLOW:
+        # Events were dropped by the kernel, so we no longer know what changed.
+        self.logger.warning("inotify queue overflowed, rescanning all manifest paths")
+        self._add_pending(self.all_manifest_paths())
+      elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        # A watched directory went away (e.g. rotation via rename). Whatever
+        # takes its place is watched again on the next flush.
+        self.inotify.remove_watch(wd)
+        self._add_pending(set())
+      elif mask & IN_IGNORED:
+        self._add_pending(set())
+      elif path is None:
+        continue
+      elif mask & IN_ISDIR:
+        # directories are not backed up, but may have to be watched
+        self._add_pending(set())
+      elif self.covered(path):
+        self._add_pending({path})
+
+    if self.has_pending and self._should_flush():
+      self.flush()
+
+  def covered(self, path):
+    # Ancestor directories are watched too, most of the files in them have
+    # nothing to do with the keybank.
+    return self.files.manifest_entry_for(self.files.get_relative_absolute_path(path, self.from_directory)) is not None
+
+  def all_manifest_paths(self):
+    paths = set(os.path.join(self.from_directory, fn.lstrip("/")) for fn in self.files.locked_manifest)
+    for entry in self.files.manifest:
+      paths.update(self.files.expand_path(entry["path"], base=self.from_directory))
+
+    return paths
+
+  def _add_pending(self, paths):
+    now = time.time()
+    if self.first_pending_at is None:
+      self.first_pending_at = now
+
+    self.last_event_at = now
+    self.pending.update(paths)
+    self.has_pending = True
+
+  def _should_flush(self):
+    now = time.time()
+    return now - self.last_event_at >= self.debounce or now - self.first_pending_at >= self.max_delay
+
+  def flush(self):
+    paths = self.pending
+    self.pending = set()
+    self.has_pending = False
+    self.first_pending_at = None
+    self.last_event_at = None
+
+    # Directories that (re)appeared since the last flush, e.g. after a rotation
+    # swapped a whole directory, never had events recorded for their contents.
+    added = set(self.update_watches())
+    if added:
+      paths.update(p for p in self.all_manifest_paths() if os.path.dirname(p) in added)
+
+    if paths:
+      with self.lock():
+        # another keybank operation may have changed the lock in the meantime
+        self.files.scan()
+        changed = self.files.backup_paths(paths, self.from_directory, self.dry_run)
+
+      if changed:
+        self.logger.info("backed up {} changed path(s)".format(len(changed)))
+        self.check_amounts()
+
+  def check_amounts(self):
+    for entry in self.files.manifest:
+      paths = self.files.expand_path(entry["path"], base=self.from_directory)
+      if len(paths) != entry["amount"]:
+        self.logger.warning("expected {} files for {} but got {}: {}".format(entry["amount"], entry["path"], len(paths), paths))
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, print_function
 
+import json
 import os
 import unittest
 import subprocess
@@ -47,6 +48,31 @@ libkeybank.utils.execute = command_executor._execute
 # We need to surpress the lint error because we need to import after the monkey
 # patch
 from libkeybank.fs import KeybankFS  # NOQA
+from libkeybank.generic_files import GenericFiles  # NOQA
+from libkeybank.utils import mkdir_p  # NOQA
+
+
+def backed_up_generic_files(tmpdir, files, manifest):
+  # Returns GenericFiles at tmpdir/generic, without a LUKS keybank, with files
+  # (paths on the machine mapped to their content) created under
+  # tmpdir/machine and backed up according to manifest.
+  generic_path = os.path.join(tmpdir, "generic")
+  from_directory = os.path.join(tmpdir, "machine")
+  mkdir_p(generic_path)
+  for path, content in files.items():
+    path = os.path.join(from_directory, path.lstrip("/"))
+    mkdir_p(os.path.dirname(path))
+    with open(path, "wb") as f:
+      f.write(content)
+
+  with open(os.path.join(generic_path, "manifest.json"), "w") as f:
+    json.dump(manifest, f)
+
+  generic_files = GenericFiles(generic_path)
+  generic_files.scan()
+  generic_files.backup(from_directory, dry_run=False)
+  generic_files.scan()
+  return generic_files
 
 
 class KeybankInfo(object):
@@ -0,0 +1,41 @@
+from __future__ import absolute_import, print_function
+
+import os
+
+from ..helpers import KeybankTestCase, KeybankInfo
+
+from libkeybank.api import Keybank
+from libkeybank.fs import KeybankFS
+from libkeybank.utils import KeybankNotAttachedError, KeybankAlreadyAttachedError
+
+
+class TestKeybankAPI(KeybankTestCase):
+  def setUp(self):
+    KeybankTestCase.setUp(self)
+    self.kbi = KeybankInfo.get()
+    self.kbi.create()
+
+  def test_context_manager_attaches_and_detaches(self):
+    KeybankFS.detach(self.kbi.name)
+
+    with Keybank(self.kbi.filepath) as kb:
+      self.assertTrue(kb.attached)
+      self.assertTrue(os.path.isdir(kb.mnt_path))
+      result = kb.verify()
+      # nothing has been backed up, so there is no locked manifest
+      self.assertFalse(result.ok)
+
+    self.assertFalse(KeybankFS.attached(self.kbi.name))
+
+  def test_context_manager_leaves_attached_keybank_attached(self):
+    with Keybank(self.kbi.filepath) as kb:
+      self.assertTrue(kb.attached)
+
+    self.assertTrue(KeybankFS.attached(self.kbi.name))
+
+  def test_errors_are_raised(self):
+    kb = Keybank(self.kbi.filepath)
+    self.assertRaises(KeybankAlreadyAttachedError, kb.attach)
+
+    KeybankFS.detach(self.kbi.name)
+    self.assertRaises(KeybankNotAttachedError, kb.verify)
@@ -0,0 +1,35 @@
+from __future__ import absolute_import, print_function
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keybank is called very frequently by monitoring (e.g. verify), so the time
+# until a command starts running is budgeted. This is generous on purpose as
+# it mostly measures the interpreter startup on slow CI machines.
+STARTUP_BUDGET_SECONDS = 0.5
+
+
+class TestStartup(unittest.TestCase):
+  def test_heavy_modules_are_imported_lazily(self):
+    code = "import sys, libkeybank.cmds; print(' '.join(sorted(sys.modules)))"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+    modules = set(output.decode("utf-8").split())
+
+    for module in ("libkeybank.fs", "libkeybank.generic_files", "libkeybank.gpg_files", "libkeybank.watch", "multiprocessing", "ctypes"):
+      self.assertNotIn(module, modules)
+
+  def test_startup_time_budget(self):
+    # Best of a few runs, to not fail on a single hiccup of the machine
+    timings = []
+    for _ in range(5):
+      start = time.time()
+      subprocess.check_output([sys.executable, os.path.join(ROOT, "keybank"), "--help"], cwd=ROOT)
+      timings.append(time.time() - start)
+
+    self.assertLess(min(timings), STARTUP_BUDGET_SECONDS, msg="keybank --help took {:.3f}s".format(min(timings)))
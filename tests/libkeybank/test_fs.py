@@ -1,10 +1,68 @@
 from __future__ import absolute_import, print_function
 
 import os
+import shutil
+import tempfile
+import unittest
 
 from ..helpers import KeybankTestCase, KeybankInfo
 
-from libkeybank.fs import KeybankFS
+from libkeybank.fs import KeybankFS, mount_options
+from libkeybank.utils import KeybankError, KeybankLockTimeoutError
+
+
+class TestMountProfiles(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.kb = KeybankFS("kb1", os.path.join(self.tmpdir, "kb1"))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_mount_options(self):
+    self.assertEqual("", mount_options("default"))
+    self.assertEqual("ro,noatime", mount_options("read", "noatime"))
+    self.assertEqual("noatime,commit=60,data=journal", mount_options("backup", "data=journal"))
+    self.assertEqual("noatime,commit=30", mount_options("backup", "commit=30"))
+    self.assertEqual("ro,noatime", mount_options("default", "rw,noatime,ro"))
+    with self.assertRaises(KeybankError):
+      mount_options("read", "rw")
+    with self.assertRaises(KeybankError):
+      mount_options("fast")
+
+  def test_recorded_profile(self):
+    self.assertEqual(("default", ""), self.kb.load_mount_profile())
+    self.kb.save_mount_profile("backup", "commit=30")
+    self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, "kb1.mount")))
+    self.assertEqual(("backup", "commit=30"), self.kb.load_mount_profile())
+
+
+class TestKeybankLock(unittest.TestCase):
+  def setUp(self):
+    self.kb = KeybankFS("lock-test")
+    self.kb.mnt_path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.kb.mnt_path)
+
+  def test_shared_locks_do_not_conflict(self):
+    with self.kb.lock():
+      with self.kb.lock(timeout=0) as waited:
+        self.assertLess(waited, 1)
+
+  def test_exclusive_lock_times_out(self):
+    with self.kb.lock():
+      with self.assertRaises(KeybankLockTimeoutError):
+        with self.kb.lock(exclusive=True, timeout=0.1):
+          pass
+
+    with self.kb.lock(exclusive=True):
+      with self.assertRaises(KeybankLockTimeoutError):
+        with self.kb.lock(timeout=0):
+          pass
+
+    with self.kb.lock(exclusive=True, timeout=0):
+      pass
 
 
 class TestKeybankFS(KeybankTestCase):
@@ -1,14 +1,17 @@
 from __future__ import absolute_import, print_function
 
+import errno
 import json
 import hashlib
 import os
 import shutil
+import tempfile
+import unittest
 
-from ..helpers import KeybankTestCase, KeybankInfo
+from ..helpers import KeybankTestCase, KeybankInfo, backed_up_generic_files
 
-from libkeybank.generic_files import GenericFiles
-from libkeybank.utils import mkdir_p
+from libkeybank.generic_files import GenericFiles, LockIndex
+from libkeybank.utils import mkdir_p, KeybankError, DEFAULT_HASH_ALGORITHM
 
 
 class TestGenericFiles(KeybankTestCase):
@@ -46,9 +49,10 @@ class TestGenericFiles(KeybankTestCase):
 
       # We always run test as root
       self.expected_locked_manifest[fn] = {
+        "algorithm": DEFAULT_HASH_ALGORITHM,
         "owner": "root",
         "group": "root",
-        "hash": hashlib.sha256(content.encode("utf-8")).hexdigest()
+        "hash": hashlib.new(DEFAULT_HASH_ALGORITHM, content.encode("utf-8")).hexdigest()
       }
 
     with open(self.manifest_path, "w") as f:
@@ -92,6 +96,126 @@ class TestGenericFiles(KeybankTestCase):
 
       self.assertEqual(expected_content, content)
 
+  def test_backup_paths(self):
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.backup("/", dry_run=False)
+    files.scan()
+
+    with open("/tmp/keybank-test/secretfile1", "w") as f:
+      f.write("rotated")
+
+    os.remove("/tmp/keybank-test/secretfile2")
+
+    with open("/tmp/keybank-test/untracked", "w") as f:
+      f.write("untracked")
+
+    changed = files.backup_paths([
+      "/tmp/keybank-test/secretfile1",
+      "/tmp/keybank-test/secretfile2",
+      "/tmp/keybank-test/untracked",
+    ], "/", dry_run=False)
+
+    self.assertEqual(["/tmp/keybank-test/secretfile1", "/tmp/keybank-test/secretfile2"], changed)
+
+    with open(self.locked_manifest_path) as f:
+      locked_manifest = json.load(f)
+
+    self.assertEqual({"/tmp/keybank-test/secretfile1", "/tmp/keybank-test/mehfile1"}, set(locked_manifest))
+    self.assertEqual(hashlib.new(DEFAULT_HASH_ALGORITHM, b"rotated").hexdigest(), locked_manifest["/tmp/keybank-test/secretfile1"]["hash"])
+    self.assertFalse(os.path.exists(os.path.join(files.path, "tmp/keybank-test/secretfile2")))
+    self.assertFalse(os.path.exists(os.path.join(files.path, "tmp/keybank-test/untracked")))
+
+  def test_iter_verify(self):
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.backup("/", dry_run=False)
+    files.scan()
+
+    os.remove(os.path.join(files.path, "tmp/keybank-test/secretfile2"))
+    with open(os.path.join(files.path, "tmp/keybank-test/secretfile1"), "w") as f:
+      f.write("corrupted")
+
+    with open(os.path.join(files.path, "tmp/keybank-test/untracked"), "w") as f:
+      f.write("untracked")
+
+    results = [(result.path, result.status) for result in files.iter_verify()]
+    self.assertEqual([
+      ("/tmp/keybank-test/mehfile1", "verified"),
+      ("/tmp/keybank-test/secretfile1", "different"),
+      ("/tmp/keybank-test/secretfile2", "missing"),
+      ("/tmp/keybank-test/untracked", "untracked"),
+    ], results)
+
+    report = files.verify_report()
+    self.assertEqual(1, report.verified)
+    self.assertEqual(["/tmp/keybank-test/untracked"], report.untracked)
+    self.assertEqual({"/tmp/keybank-test/secretfile1", "/tmp/keybank-test/secretfile2"}, set(report.differences))
+    self.assertIsNone(report.differences["/tmp/keybank-test/secretfile2"].actual)
+
+  def test_verify_legacy_sha256_lock(self):
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.hash_algorithm = "sha256"
+    files.backup("/", dry_run=False)
+
+    # Locks written before the algorithm was recorded have no algorithm tag
+    with open(self.locked_manifest_path) as f:
+      locked_manifest = json.load(f)
+
+    for entry in locked_manifest.values():
+      self.assertEqual("sha256", entry.pop("algorithm"))
+
+    with open(self.locked_manifest_path, "w") as f:
+      json.dump(locked_manifest, f)
+
+    files.scan()
+    self.assertEqual({}, files.verify())
+
+    with open(os.path.join(files.path, "tmp/keybank-test/mehfile1"), "w") as f:
+      f.write("corrupted")
+
+    differences = files.verify()
+    self.assertEqual(hashlib.sha256(b"corrupted").hexdigest(), differences["/tmp/keybank-test/mehfile1"].actual)
+
+  def test_drift(self):
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.backup("/", dry_run=False)
+    files.scan()
+
+    report = files.drift("/")
+    self.assertEqual({}, report.changed)
+    self.assertEqual([], report.missing)
+    self.assertEqual([], report.new)
+
+    with open("/tmp/keybank-test/secretfile1", "w") as f:
+      f.write("rotated")
+
+    os.remove("/tmp/keybank-test/mehfile1")
+
+    with open("/tmp/keybank-test/secretfile3", "w") as f:
+      f.write("secretfile3content")
+
+    report = files.drift("/")
+    self.assertEqual(["/tmp/keybank-test/secretfile1"], list(report.changed))
+    self.assertEqual(["/tmp/keybank-test/mehfile1"], report.missing)
+    self.assertEqual(["/tmp/keybank-test/secretfile3"], report.new)
+
+    # drift must never write to the keybank
+    with open(os.path.join(files.path, "tmp/keybank-test/secretfile1")) as f:
+      self.assertEqual("secretfile1content", f.read())
+
+  def test_selective_restore(self):
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.backup("/", dry_run=False)
+    for fn in self.files:
+      os.remove(fn)
+
+    files.scan()
+    restored = files.restore("/", dry_run=False, only=["/tmp/keybank-test/mehfile1"])
+    self.assertEqual(["/tmp/keybank-test/mehfile1"], restored)
+    self.assertTrue(os.path.exists("/tmp/keybank-test/mehfile1"))
+    self.assertFalse(os.path.exists("/tmp/keybank-test/secretfile1"))
+
+    self.assertRaises(KeybankError, files.restore, "/", False, only=["/tmp/keybank-test/nope"])
+
   def test_verify(self):
     files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
     # We should return a truthy value to indicate there are differences.
@@ -106,7 +230,7 @@ class TestGenericFiles(KeybankTestCase):
 
     path_to_modify = "/tmp/keybank-test/secretfile1"
     content = "corrupted".encode("utf-8")
-    modified_sha = hashlib.sha256(content).hexdigest()
+    modified_sha = hashlib.new(DEFAULT_HASH_ALGORITHM, content).hexdigest()
 
     with open(os.path.join(files.path, path_to_modify.lstrip("/")), "w") as f:
       f.write("corrupted")
@@ -116,6 +240,229 @@ class TestGenericFiles(KeybankTestCase):
     self.assertEqual(self.expected_locked_manifest[path_to_modify]["hash"], differences[path_to_modify].expected)
     self.assertEqual(modified_sha, differences[path_to_modify].actual)
 
+  def test_chunked_verify_and_repair(self):
+    big_path = "/tmp/keybank-test/secretfile3"
+    with open(big_path, "wb") as f:
+      f.write(os.urandom(100000))
+
+    self.expected_manifest[0]["amount"] = 3
+    with open(self.manifest_path, "w") as f:
+      json.dump(self.expected_manifest, f)
+
+    files = GenericFiles(os.path.join(self.kbi.mnt_path, "generic"))
+    files.chunk_size = 16384
+    files.backup("/", dry_run=False)
+    files.scan()
+
+    entry = files.locked_manifest[big_path]
+    self.assertEqual(7, len(entry["chunks"]))
+    self.assertNotIn("chunks", files.locked_manifest["/tmp/keybank-test/secretfile1"])
+    self.assertEqual({}, files.verify())
+
+    with open(os.path.join(files.path, big_path.lstrip("/")), "r+b") as f:
+      f.seek(20000)
+      f.write(b"corrupted")
+
+    differences = files.verify()
+    self.assertEqual([(16384, 32768)], differences[big_path].ranges)
+
+    self.assertEqual([], files.repair("/", dry_run=False))
+    self.assertEqual({}, files.verify())
+
   def tearDown(self):
     KeybankTestCase.tearDown(self)
     shutil.rmtree("/tmp/keybank-test")
+
+
+class TestLockIndex(unittest.TestCase):
+  def setUp(self):
+    self.index = LockIndex({
+      "/home/john/.ssh/id_rsa": {},
+      "/home/john/.ssh/id_rsa.pub": {},
+      "/home/john/.ssh-backup/id_rsa": {},
+      "/home/mary/.ssh/id_ed25519": {},
+      "/etc/ssh/ssh_host_rsa_key": {},
+    })
+
+  def test_exact_path(self):
+    self.assertEqual(["/home/john/.ssh/id_rsa"], self.index.match("/home/john/.ssh/id_rsa"))
+    self.assertEqual(["/etc/ssh/ssh_host_rsa_key"], self.index.match("etc/ssh/ssh_host_rsa_key"))
+
+  def test_glob(self):
+    self.assertEqual(["/home/john/.ssh/id_rsa", "/home/john/.ssh/id_rsa.pub"], self.index.match("/home/john/.ssh/id_*"))
+    self.assertEqual(["/home/john/.ssh/id_rsa", "/home/mary/.ssh/id_ed25519"], self.index.match("/home/*/.ssh/id_[re]*[a9]"))
+
+  def test_directory(self):
+    self.assertEqual(["/home/john/.ssh/id_rsa", "/home/john/.ssh/id_rsa.pub"], self.index.match("/home/john/.ssh"))
+    self.assertEqual([], self.index.match("/home/jo"))
+
+  def test_select(self):
+    self.assertEqual(["/etc/ssh/ssh_host_rsa_key", "/home/mary/.ssh/id_ed25519"], self.index.select(["/home/mary", "/etc/ssh/*", "/home/mary/.ssh/id_ed25519"]))
+    self.assertRaises(KeybankError, self.index.select, ["/nope"])
+
+
+class TestBackupPaths(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.from_directory = os.path.join(self.tmpdir, "machine")
+    self.key_path = os.path.join(self.from_directory, "keys", "id_rsa")
+    files = backed_up_generic_files(self.tmpdir, {"/keys/id_rsa": b"key" * 1000}, [{"path": "/keys/id_rsa", "amount": 1}])
+    files.chunk_size = 1024
+    files.backup(self.from_directory, dry_run=False)
+
+    # like watch, which does not know the chunk size of the backup
+    self.files = GenericFiles(files.path)
+    self.files.scan()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_keeps_chunked_entries(self):
+    entry = self.files.locked_manifest["/keys/id_rsa"]
+    self.assertEqual(3, len(entry["chunks"]))
+
+    os.utime(self.key_path, None)
+    self.assertEqual([], self.files.backup_paths([self.key_path], self.from_directory, dry_run=False))
+    self.assertEqual(entry, self.files.locked_manifest["/keys/id_rsa"])
+
+    with open(self.key_path, "wb") as f:
+      f.write(b"new" * 1000)
+
+    self.assertEqual(["/keys/id_rsa"], self.files.backup_paths([self.key_path], self.from_directory, dry_run=False))
+    new_entry = self.files.locked_manifest["/keys/id_rsa"]
+    self.assertNotEqual(entry["hash"], new_entry["hash"])
+    self.assertEqual((1024, 3000, 3), (new_entry["chunk_size"], new_entry["size"], len(new_entry["chunks"])))
+    self.assertEqual({}, self.files.verify_report().differences)
+
+  def test_unexpected_amount_raises_keybank_error(self):
+    self.files.manifest = [{"path": "/keys/*", "amount": 2}]
+    with self.assertRaises(KeybankError):
+      self.files.backup(self.from_directory, dry_run=True)
+
+
+class TestDrift(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.from_directory = os.path.join(self.tmpdir, "machine")
+    self.files = backed_up_generic_files(self.tmpdir, {"/keys/id_rsa": b"key"}, [{"path": "/keys/id_rsa", "amount": 1}])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_owner_without_name(self):
+    # no user or group 54321 on the machine
+    os.chown(os.path.join(self.from_directory, "keys", "id_rsa"), 54321, 54321)
+    entry = self.files.locked_manifest["/keys/id_rsa"]
+    report = self.files.drift(self.from_directory)
+    expected = "owner:group changed from {}:{} to 54321:54321".format(entry["owner"], entry["group"])
+    self.assertEqual({"/keys/id_rsa": expected}, report.changed)
+
+
+class TestHashAlgorithm(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.from_directory = os.path.join(self.tmpdir, "machine")
+    self.files = backed_up_generic_files(self.tmpdir, {"/keys/id_rsa": b"key"}, [{"path": "/keys/id_rsa", "amount": 1}])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_keeps_recorded_algorithm(self):
+    self.assertEqual(DEFAULT_HASH_ALGORITHM, self.files.locked_manifest["/keys/id_rsa"]["algorithm"])
+
+    self.files.hash_algorithm = "sha512"
+    self.files.backup(self.from_directory, dry_run=False)
+    entry = self.files.locked_manifest["/keys/id_rsa"]
+    self.assertEqual("sha512", entry["algorithm"])
+
+    # without an explicit algorithm backups do not change the lock
+    self.files.hash_algorithm = None
+    self.files.backup(self.from_directory, dry_run=False)
+    self.assertEqual(entry, self.files.locked_manifest["/keys/id_rsa"])
+
+
+class TestRestoreMany(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.files = backed_up_generic_files(self.tmpdir, {"/keys/id_rsa": b"key" * 1000000}, [{"path": "/keys/id_rsa", "amount": 1}])
+
+    self.targets = [os.path.join(self.tmpdir, name) for name in ("host", "container", "broken")]
+    for target in self.targets:
+      mkdir_p(target)
+
+    # the container has its own users and groups, the broken one lacks root
+    mkdir_p(os.path.join(self.targets[1], "etc"))
+    with open(os.path.join(self.targets[1], "etc", "passwd"), "w") as f:
+      f.write("root:x:100000:100000:root:/root:/bin/sh\n")
+    with open(os.path.join(self.targets[1], "etc", "group"), "w") as f:
+      f.write("root:x:100000:\n")
+
+    mkdir_p(os.path.join(self.targets[2], "etc"))
+    with open(os.path.join(self.targets[2], "etc", "passwd"), "w") as f:
+      f.write("nobody:x:65534:65534::/:/bin/false\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_restore_many(self):
+    report = self.files.restore_many(self.targets, dry_run=False)
+    host, container, broken = self.targets
+    self.assertEqual(["/keys/id_rsa"], report.restored[host])
+    self.assertEqual(["/keys/id_rsa"], report.restored[container])
+    self.assertEqual([], report.restored[broken])
+    self.assertEqual(["/keys/id_rsa"], list(report.failed[broken]))
+    self.assertFalse(os.path.exists(os.path.join(broken, "keys", "id_rsa")))
+
+    for target, uid in ((host, 0), (container, 100000)):
+      path = os.path.join(target, "keys", "id_rsa")
+      with open(path, "rb") as f:
+        self.assertEqual(b"key" * 1000000, f.read())
+
+      stat = os.stat(path)
+      self.assertEqual((uid, uid, 0o600), (stat.st_uid, stat.st_gid, stat.st_mode & 0o777))
+
+    with self.assertRaises(KeybankError):
+      self.files.restore(broken, dry_run=False)
+
+  def test_write_failure_keeps_existing_file(self):
+    host, container, _ = self.targets
+    existing_path = os.path.join(container, "keys", "id_rsa")
+    mkdir_p(os.path.dirname(existing_path))
+    with open(existing_path, "wb") as f:
+      f.write(b"old key")
+
+    open_restore_file = self.files._open_restore_file
+
+    def open_failing_in_container(to_path):
+      tmp_path, f = open_restore_file(to_path)
+      if to_path.startswith(container):
+        f = FailingFile(f)
+      return tmp_path, f
+
+    self.files._open_restore_file = open_failing_in_container
+    report = self.files.restore_many([host, container], dry_run=False)
+    self.assertEqual(["/keys/id_rsa"], report.restored[host])
+    self.assertEqual(["/keys/id_rsa"], list(report.failed[container]))
+
+    with open(existing_path, "rb") as f:
+      self.assertEqual(b"old key", f.read())
+
+    self.assertEqual(["id_rsa"], os.listdir(os.path.dirname(existing_path)))
+    with open(os.path.join(host, "keys", "id_rsa"), "rb") as f:
+      self.assertEqual(b"key" * 1000000, f.read())
+
+
+class FailingFile(object):
+  # Fails the second write, like a disk filling up.
+  def __init__(self, f):
+    self.f = f
+    self.writes = 0
+
+  def write(self, buf):
+    self.writes += 1
+    if self.writes == 2:
+      raise IOError(errno.ENOSPC, "No space left on device")
+    self.f.write(buf)
+
+  def close(self):
+    self.f.close()
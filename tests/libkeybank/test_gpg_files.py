@@ -1,9 +1,15 @@
 from __future__ import absolute_import, print_function
 
+import json
 import os
+import shutil
 
 from ..helpers import KeybankTestCase, KeybankInfo
 
+from libkeybank.gpg_files import GPGFiles
+
+TESTDATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "testdata", "gpg")
+
 
 class TestGPGFiles(KeybankTestCase):
   def setUp(self):
@@ -12,3 +18,36 @@ class TestGPGFiles(KeybankTestCase):
     self.kb = self.kbi.create()
 
     self.gpg_base_path = os.path.join(self.kbi.mnt_path, "gpg")
+
+    self.home = "/tmp/keybank-test-gnupg"
+    shutil.copytree(os.path.join(TESTDATA_PATH, "johndoe"), self.home)
+
+    with open(os.path.join(self.gpg_base_path, "manifest.json"), "w") as f:
+      json.dump({"johndoe": self.home}, f)
+
+  def test_incremental_backup(self):
+    files = GPGFiles(self.gpg_base_path)
+    changed = files.backup("/", dry_run=False)
+    self.assertEqual({"johndoe": ["pubring.gpg", "secring.gpg", "trustdb.gpg"]}, changed)
+    self.assertEqual(["johndoe"], files.gpg_homes)
+    # random_seed is not part of the keyrings
+    self.assertFalse(os.path.exists(os.path.join(self.gpg_base_path, "johndoe", "random_seed")))
+
+    with open(os.path.join(self.gpg_base_path, "johndoe.json.lock")) as f:
+      self.assertEqual({"pubring.gpg", "secring.gpg", "trustdb.gpg"}, set(json.load(f)))
+
+    self.assertEqual({"johndoe": []}, files.backup("/", dry_run=False))
+
+    with open(os.path.join(self.home, "trustdb.gpg"), "ab") as f:
+      f.write(b"changed")
+
+    os.remove(os.path.join(self.home, "secring.gpg"))
+
+    self.assertEqual({"johndoe": ["trustdb.gpg", "secring.gpg"]}, files.backup("/", dry_run=False))
+    self.assertFalse(os.path.exists(os.path.join(self.gpg_base_path, "johndoe", "secring.gpg")))
+    with open(os.path.join(self.gpg_base_path, "johndoe", "trustdb.gpg"), "rb") as f:
+      self.assertTrue(f.read().endswith(b"changed"))
+
+  def tearDown(self):
+    KeybankTestCase.tearDown(self)
+    shutil.rmtree(self.home)
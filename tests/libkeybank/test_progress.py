@@ -0,0 +1,57 @@
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+  from StringIO import StringIO  # python 2, takes native str
+except ImportError:
+  from io import StringIO
+
+from ..helpers import backed_up_generic_files
+
+from libkeybank.progress import Progress, format_bytes, format_duration
+
+
+class TestProgress(unittest.TestCase):
+  def test_format(self):
+    self.assertEqual("512 B", format_bytes(512))
+    self.assertEqual("1.5 MB", format_bytes(1500000))
+    self.assertEqual("2.0 TB", format_bytes(2 * 10 ** 12))
+    self.assertEqual("1:02:03", format_duration(3723.9))
+
+  def test_status(self):
+    progress = Progress(stream=StringIO(), tty=True)
+    progress.start("backing up generic files", 4, 4000)
+    progress.started_at -= 10
+    progress.add_bytes(1000)
+    progress.file_done()
+
+    status = progress.status()
+    self.assertTrue(status.startswith("backing up generic files: 1/4 files, 1.0 KB of 4.0 KB"), status)
+    self.assertTrue(status.endswith("ETA 0:00:30"), status)
+
+  def test_tty_redraws_one_line(self):
+    stream = StringIO()
+    progress = Progress(stream=stream, tty=True, interval=0)
+    progress.start("verifying generic files", 2, None)
+    progress.file_done()
+    progress.file_done()
+    progress.finish()
+
+    self.assertNotIn("\n", stream.getvalue())
+    self.assertTrue(stream.getvalue().endswith("\r\033[K"))
+    self.assertIn("2/2 files", stream.getvalue())
+
+  def test_backup_counts_hashing_and_copying(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      files = backed_up_generic_files(tmpdir, {"/keys/id_rsa": b"key" * 1000000}, [{"path": "/keys/id_rsa", "amount": 1}])
+      files.progress = Progress(stream=StringIO(), tty=False)
+      files.backup(os.path.join(tmpdir, "machine"), dry_run=False)
+      self.assertEqual(6000000, files.progress.total_bytes)
+      self.assertEqual(6000000, files.progress.bytes_done)
+    finally:
+      shutil.rmtree(tmpdir)
@@ -0,0 +1,74 @@
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from libkeybank.replicate import BlockReplicator
+
+
+class TestBlockReplicator(unittest.TestCase):
+  block_size = 4096
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmpdir, "kb")
+    self.dest = os.path.join(self.tmpdir, "kb-offsite")
+
+    # A sparse file with data in the first and last few blocks only, like a
+    # freshly created keybank.
+    self.size = 64 * self.block_size
+    with open(self.src, "wb") as f:
+      f.write(os.urandom(3 * self.block_size))
+      f.seek(self.size - self.block_size)
+      f.write(os.urandom(self.block_size))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def replicate(self):
+    return BlockReplicator(self.src, self.dest, block_size=self.block_size).replicate()
+
+  def assertReplicated(self):
+    with open(self.src, "rb") as f:
+      src_content = f.read()
+
+    with open(self.dest, "rb") as f:
+      self.assertEqual(src_content, f.read())
+
+  def test_initial_replication_keeps_holes(self):
+    report = self.replicate()
+    self.assertEqual(64, report.blocks)
+    self.assertEqual(4, report.copied)
+    self.assertReplicated()
+    self.assertLess(os.stat(self.dest).st_blocks * 512, self.size)
+
+  def test_incremental_replication(self):
+    self.replicate()
+
+    with open(self.src, "r+b") as f:
+      f.seek(10 * self.block_size + 100)
+      f.write(b"changed")
+      f.seek(0)
+      f.write(b"\0" * self.block_size)
+
+    report = self.replicate()
+    self.assertFalse(report.full_scan)
+    self.assertEqual(2, report.copied)
+    self.assertEqual(self.block_size, report.bytes_copied)
+    self.assertReplicated()
+
+    self.assertEqual(0, self.replicate().copied)
+
+  def test_destination_changed_outside_of_replication(self):
+    self.replicate()
+
+    with open(self.dest, "r+b") as f:
+      f.seek(self.block_size)
+      f.write(b"tampered")
+
+    report = self.replicate()
+    self.assertTrue(report.full_scan)
+    self.assertEqual(1, report.copied)
+    self.assertReplicated()
@@ -0,0 +1,88 @@
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..helpers import backed_up_generic_files
+
+from libkeybank.scrub import Scrubber, RateLimiter
+from libkeybank.utils import KeybankScrubInProgressError
+
+
+class TestScrubber(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.state_path = os.path.join(self.tmpdir, "scrub.json")
+    contents = dict(("/keys/" + name, name.encode("utf-8") * 1000) for name in ("a", "b", "c", "d"))
+    self.files = backed_up_generic_files(self.tmpdir, contents, [{"path": "/keys/*", "amount": 4}])
+    self.generic_path = self.files.path
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def scrub(self, **kwargs):
+    return Scrubber(self.files, self.state_path).run(**kwargs)
+
+  def load_state(self):
+    with open(self.state_path) as f:
+      return json.load(f)
+
+  def test_resumes_where_it_stopped(self):
+    report = self.scrub(max_bytes=1500)
+    self.assertEqual(2, report.verified)
+    self.assertEqual(2000, report.bytes_read)
+    self.assertFalse(report.complete)
+    self.assertEqual("/keys/b", self.load_state()["cursor"])
+
+    with open(os.path.join(self.generic_path, "keys", "c"), "wb") as f:
+      f.write(b"corrupted")
+
+    report = self.scrub()
+    self.assertTrue(report.complete)
+    self.assertEqual(1, report.verified)
+    self.assertEqual(["/keys/c"], list(report.differences))
+
+    state = self.load_state()
+    self.assertIsNone(state["cursor"])
+    self.assertIsNotNone(state["last_pass_completed_at"])
+    self.assertEqual(["/keys/a", "/keys/b", "/keys/c", "/keys/d"], sorted(state["files"]))
+    self.assertEqual("different", state["files"]["/keys/c"]["status"])
+
+    # the next run starts a new pass
+    report = self.scrub(max_bytes=1)
+    self.assertEqual(1, report.verified)
+    self.assertEqual("/keys/a", self.load_state()["cursor"])
+
+  def test_concurrent_scrubs(self):
+    # the first scrub takes about 1.5s at 2000 bytes/s
+    reports = []
+    first = threading.Thread(target=lambda: reports.append(Scrubber(self.files, self.state_path, rate=2000).run()))
+    first.start()
+    time.sleep(0.3)
+    try:
+      with self.assertRaises(KeybankScrubInProgressError):
+        self.scrub()
+    finally:
+      first.join()
+
+    self.assertEqual(4, reports[0].verified)
+    self.assertTrue(reports[0].complete)
+    self.assertIsNone(self.load_state()["cursor"])
+    self.assertEqual(4, self.scrub().verified)
+
+
+class TestRateLimiter(unittest.TestCase):
+  def test_consume_throttles(self):
+    limiter = RateLimiter(1000)
+    start = time.time()
+    for _ in range(3):
+      limiter.consume(100)
+    self.assertLess(time.time() - start, 0.5)
+
+    limiter.consume(200)
+    self.assertGreaterEqual(time.time() - start, 0.45)
@@ -0,0 +1,42 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from libkeybank.utils import hash_file, hash_file_chunks, merkle_root, new_hash, path_matches_glob, KeybankError
+
+
+class TestUtils(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "file")
+    self.content = os.urandom(10000)
+    with open(self.path, "wb") as f:
+      f.write(self.content)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_path_matches_glob(self):
+    self.assertTrue(path_matches_glob("/home/john/.ssh/id_rsa", "/home/*/.ssh/id_*"))
+    self.assertFalse(path_matches_glob("/home/john/.ssh/id_rsa", "/home/*"))
+    self.assertFalse(path_matches_glob("/home/john/.hidden", "/home/john/*"))
+
+  def test_unsupported_hash_algorithm(self):
+    with self.assertRaises(KeybankError):
+      new_hash("md4x")
+
+  def test_hash_file_chunks(self):
+    chunks = hash_file_chunks(self.path, 4096, jobs=3)
+    expected = [hashlib.sha256(self.content[i:i + 4096]).hexdigest() for i in range(0, len(self.content), 4096)]
+    self.assertEqual(expected, chunks)
+    self.assertEqual(chunks, hash_file_chunks(self.path, 4096, jobs=1))
+
+  def test_merkle_root(self):
+    chunks = hash_file_chunks(self.path, 4096)
+    self.assertEqual(chunks[0], merkle_root(chunks[:1]))
+    self.assertNotEqual(merkle_root(chunks), merkle_root(list(reversed(chunks))))
+    self.assertEqual(hash_file(os.devnull), merkle_root([]))
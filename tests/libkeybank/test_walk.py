@@ -0,0 +1,73 @@
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from libkeybank.walk import ExcludeRules, glob_paths, walk_files
+
+
+class TestWalk(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    for path in ("a/x", "a-b/y", "a.c", "b/c/d", "b/c-e", "b/state.lock", "home/john/.ssh/id_rsa", "home/john/.ssh/id_rsa.pub", "home/john/.cache/id_rsa", "home/mary/.ssh/id_rsa"):
+      path = os.path.join(self.tmpdir, path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+      with open(path, "w") as f:
+        f.write("x")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_walk_files_is_sorted(self):
+    paths = [relative_path for relative_path, _ in walk_files(self.tmpdir)]
+    self.assertEqual(sorted(paths), paths)
+    self.assertEqual(["/a-b/y", "/a.c", "/a/x", "/b/c-e", "/b/c/d", "/b/state.lock"], paths[:6])
+
+  def test_walk_files_excludes(self):
+    excludes = ExcludeRules(["c", "*.lock", "/home/*/.cache", "/home/mary"])
+    paths = [relative_path for relative_path, _ in walk_files(self.tmpdir, excludes)]
+    self.assertEqual(["/a-b/y", "/a.c", "/a/x", "/b/c-e", "/home/john/.ssh/id_rsa", "/home/john/.ssh/id_rsa.pub"], paths)
+
+  def test_walk_files_skips_sockets(self):
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+      sock.bind(os.path.join(self.tmpdir, "a", "agent.sock"))
+      paths = [relative_path for relative_path, _ in walk_files(os.path.join(self.tmpdir, "a"))]
+      self.assertEqual(["/x"], paths)
+    finally:
+      sock.close()
+
+  def test_glob_paths_skips_sockets_and_fifos(self):
+    os.mkfifo(os.path.join(self.tmpdir, "a", "fifo"))
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+      sock.bind(os.path.join(self.tmpdir, "a", "agent.sock"))
+      self.assertEqual([os.path.join(self.tmpdir, "a", "x")], glob_paths(self.tmpdir, "/a/*"))
+      self.assertEqual([], glob_paths(self.tmpdir, "/a/fifo"))
+      self.assertEqual([], glob_paths(self.tmpdir, "/a"))
+    finally:
+      sock.close()
+
+  def test_glob_paths(self):
+    def relative(paths):
+      return [os.path.relpath(p, self.tmpdir) for p in paths]
+
+    self.assertEqual(["home/john/.ssh/id_rsa", "home/mary/.ssh/id_rsa"], relative(glob_paths(self.tmpdir, "/home/*/.ssh/id_rsa")))
+    self.assertEqual(["home/john/.ssh/id_rsa", "home/john/.ssh/id_rsa.pub"], relative(glob_paths(self.tmpdir, "/home/john/.ssh/id_*")))
+    # wildcards do not match hidden files, just like glob
+    self.assertEqual([], relative(glob_paths(self.tmpdir, "/home/john/*/id_rsa")))
+    self.assertEqual(["home/john/.ssh/id_rsa"], relative(glob_paths(self.tmpdir, "/home/*/.ssh/id_rsa", ExcludeRules(["/home/mary"]))))
+    self.assertEqual(["home/john/.ssh/id_rsa"], relative(glob_paths(self.tmpdir, "/home/john/.ssh/id_*", ExcludeRules(["*.pub"]))))
+    self.assertEqual([], glob_paths(self.tmpdir, "/nope/*"))
+
+  def test_path_exclude_rules_do_not_cross_directories(self):
+    excludes = ExcludeRules(["/home/*"])
+    self.assertTrue(excludes.excluded("/home/john", "john"))
+    self.assertFalse(excludes.excluded("/home/john/.ssh", ".ssh"))
+    self.assertTrue(ExcludeRules(["/a/[!b]c"]).excluded("/a/xc", "xc"))
+    self.assertFalse(ExcludeRules(["/a/[!b]c"]).excluded("/a/bc", "bc"))
@@ -0,0 +1,117 @@
+from __future__ import absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..helpers import backed_up_generic_files
+
+from libkeybank.watch import Inotify, ManifestWatcher, IN_CLOSE_WRITE
+
+
+def write(path, content):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+
+  with open(path, "wb") as f:
+    f.write(content)
+
+
+class TestInotify(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.inotify = Inotify()
+
+  def tearDown(self):
+    self.inotify.close()
+    shutil.rmtree(self.tmpdir)
+
+  def test_events(self):
+    wd = self.inotify.add_watch(self.tmpdir)
+    write(os.path.join(self.tmpdir, "key"), b"key")
+    events = [(mask, path) for _, mask, path in self.inotify.read_events(1.0)]
+    self.assertIn(os.path.join(self.tmpdir, "key"), [path for mask, path in events if mask & IN_CLOSE_WRITE])
+
+    self.inotify.remove_watch(wd)
+    self.assertEqual({}, self.inotify.watches)
+    write(os.path.join(self.tmpdir, "key"), b"changed")
+    self.assertEqual([], [path for _, _, path in self.inotify.read_events(0.2) if path is not None])
+
+
+class TestManifestWatcher(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.machine = os.path.join(self.tmpdir, "machine")
+    contents = {"/etc/ssl/key": b"key", "/etc/letsencrypt/live/a.org/cert.pem": b"a.org"}
+    manifest = [{"path": "/etc/ssl/*", "amount": 1}, {"path": "/etc/letsencrypt/live/*/cert.pem", "amount": 1}]
+    self.files = backed_up_generic_files(self.tmpdir, contents, manifest)
+    self.watcher = ManifestWatcher(self.files, self.machine, debounce=0.3)
+    self.watcher.inotify = Inotify()
+    self.watcher.update_watches()
+
+  def tearDown(self):
+    self.watcher.inotify.close()
+    shutil.rmtree(self.tmpdir)
+
+  def machine_path(self, fn):
+    return os.path.join(self.machine, fn.lstrip("/"))
+
+  def backed_up(self, fn):
+    with open(self.files.keybank_path(fn), "rb") as f:
+      return f.read()
+
+  def settle(self):
+    # polls until the pending changes are backed up
+    deadline = time.time() + 5
+    self.watcher.poll(max_wait=0.2)
+    while self.watcher.has_pending and time.time() < deadline:
+      self.watcher.poll(max_wait=0.2)
+
+  def test_watched_directories(self):
+    self.assertEqual(set(self.machine_path(d) for d in ("/etc/ssl", "/etc/letsencrypt/live", "/etc/letsencrypt/live/a.org")), self.watcher.watched_directories())
+
+    shutil.rmtree(self.machine_path("/etc/letsencrypt"))
+    self.assertEqual(set(self.machine_path(d) for d in ("/etc/ssl", "/etc")), self.watcher.watched_directories())
+
+  def test_debounce(self):
+    write(self.machine_path("/etc/ssl/key"), b"changed")
+    self.watcher.poll(max_wait=1.0)
+    self.assertEqual({self.machine_path("/etc/ssl/key")}, self.watcher.pending)
+    self.assertEqual(b"key", self.backed_up("/etc/ssl/key"))
+
+    self.settle()
+    self.assertFalse(self.watcher.has_pending)
+    self.assertEqual(b"changed", self.backed_up("/etc/ssl/key"))
+
+  def test_ignores_files_outside_the_manifest(self):
+    write(self.machine_path("/etc/letsencrypt/live/README"), b"readme")
+    self.watcher.poll(max_wait=1.0)
+    self.assertFalse(self.watcher.has_pending)
+
+  def test_new_glob_directory(self):
+    write(self.machine_path("/etc/letsencrypt/live/b.org/cert.pem"), b"b.org")
+    self.settle()
+    # the file was written before the new directory was watched
+    self.assertEqual(b"b.org", self.backed_up("/etc/letsencrypt/live/b.org/cert.pem"))
+
+    write(self.machine_path("/etc/letsencrypt/live/b.org/cert.pem"), b"b.org renewed")
+    self.settle()
+    self.assertEqual(b"b.org renewed", self.backed_up("/etc/letsencrypt/live/b.org/cert.pem"))
+
+  def test_directory_rotation(self):
+    write(self.machine_path("/etc/ssl.new/key"), b"rotated")
+    os.rename(self.machine_path("/etc/ssl"), self.machine_path("/etc/ssl.old"))
+    os.rename(self.machine_path("/etc/ssl.new"), self.machine_path("/etc/ssl"))
+    self.settle()
+    self.assertEqual(b"rotated", self.backed_up("/etc/ssl/key"))
+
+    # the old directory is no longer watched, the new one is
+    write(self.machine_path("/etc/ssl.old/key"), b"old")
+    self.watcher.poll(max_wait=0.5)
+    self.assertFalse(self.watcher.has_pending)
+
+    write(self.machine_path("/etc/ssl/key"), b"written")
+    self.settle()
+    self.assertEqual(b"written", self.backed_up("/etc/ssl/key"))